@@ -5,6 +5,10 @@ from openpyxl import Workbook, load_workbook
 import tkinter as tk
 from tkinter import filedialog, messagebox
 
+# Módulo de exportación compartido con la aplicación (carpeta superior a TOOLs)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from exportar_xlsx import exportar_consulta
+
 # ========== SECCIÓN DE COLORES (EDITABLE) ==========
 # Puedes cambiar los códigos ANSI aquí para modificar los colores
 COLORS = {
@@ -232,18 +236,11 @@ def migrate_db_sqlite_to_xlsx():
     # --- LÓGICA ORIGINAL DE migrate_db_sqlite_to_xlsx.py ---
     try:
         conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        wb = Workbook()
-        ws = wb.active
-        ws.append(['SKU', 'Titulo', 'EANs'])
-        cursor.execute('SELECT sku, titulo, eans FROM productos')
-        productos = cursor.fetchall()
-        total_productos = len(productos)
+        total_productos = conn.execute('SELECT COUNT(*) FROM productos').fetchone()[0]
         print_log(f'[MIGRATE_DB_SQLITE_TO_XLSX] Iniciando la migración de {total_productos} productos...', "progress")
-        for idx, producto in enumerate(productos, start=1):
-            ws.append(producto)
-            print_log(f'Progreso: {idx}/{total_productos} productos migrados', "progress")
-        wb.save(xlsx_path)
+        # Exportación en streaming (write-only + fetchmany): memoria constante aunque el catálogo sea muy grande
+        exportar_consulta(xlsx_path, ['SKU', 'Titulo', 'EANs'], conn, 'SELECT sku, titulo, eans FROM productos',
+                          progreso=lambda idx: print_log(f'Progreso: {idx}/{total_productos} productos migrados', "progress"))
         conn.close()
         print_log('[MIGRATE_DB_SQLITE_TO_XLSX] Migración completada de SQLite a Excel.', "success")
     except Exception as e:
@@ -0,0 +1,48 @@
+# Exportación de archivos xlsx en modo write-only (compartida por main2.py y TOOLs/main_interactive_db_tool.py)
+#
+# openpyxl en modo normal mantiene todo el libro en memoria; en modo write-only cada fila se serializa
+# al añadirla, así que exportar un catálogo de 1M de filas o un mes de revisiones usa memoria constante.
+
+from openpyxl import Workbook
+
+EXPORT_FETCH_SIZE = 1000  # Filas leídas de SQLite por cada fetchmany
+
+
+def filas_cursor(cursor, tamano_bloque=EXPORT_FETCH_SIZE):
+    """Recorre el resultado de un cursor ya ejecutado por bloques de fetchmany, sin cargarlo entero."""
+    while True:
+        bloque = cursor.fetchmany(tamano_bloque)
+        if not bloque:
+            break
+        yield from bloque
+
+
+def exportar_filas(ruta, encabezados, filas, titulo=None, progreso=None, cada=EXPORT_FETCH_SIZE):
+    """
+    Escribe un xlsx con una fila de encabezados y las filas de cualquier iterable (generador, cursor...).
+    progreso(n) se llama cada `cada` filas y al terminar. Devuelve el número de filas escritas.
+    Puede lanzar PermissionError si el archivo está abierto en otro programa.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(titulo)
+    ws.append(encabezados)
+    total = 0
+    for fila in filas:
+        ws.append(list(fila))
+        total += 1
+        if progreso and total % cada == 0:
+            progreso(total)
+    wb.save(ruta)
+    if progreso:
+        progreso(total)
+    return total
+
+
+def exportar_consulta(ruta, encabezados, conn, sql, parametros=(), titulo=None, progreso=None, tamano_bloque=EXPORT_FETCH_SIZE):
+    """Ejecuta una consulta SQLite y exporta su resultado a xlsx en streaming. Devuelve el número de filas."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, parametros)
+        return exportar_filas(ruta, encabezados, filas_cursor(cursor, tamano_bloque), titulo, progreso, tamano_bloque)
+    finally:
+        cursor.close()
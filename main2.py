@@ -22,18 +22,41 @@ from kivy.uix.screenmanager import ScreenManager, Screen
 from kivy.uix.filechooser import FileChooserIconView, FileChooserListView
 from kivy.uix.togglebutton import ToggleButton
 from kivy.uix.scrollview import ScrollView
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.properties import ObjectProperty
 from kivy.animation import Animation
 
 # Standard Library Imports
 import os
+import sys
+import math
+import time
+import hashlib
+import threading
 import sqlite3
 import logging
+import glob
+import json
+import uuid
+import re
+import zipfile
+import unicodedata
+import xml.etree.ElementTree as ET
 from datetime import datetime
+from array import array
+from collections import deque
+from itertools import islice
+from functools import partial
 
 # Third-Party Library Imports
-from openpyxl import load_workbook, Workbook
+from openpyxl import load_workbook
 import psutil
 
+# Local Imports
+from exportar_xlsx import exportar_filas, exportar_consulta, EXPORT_FETCH_SIZE
+
 # Configurar el nivel de registro para ocultar mensajes de error específicos
 Logger.setLevel(logging.CRITICAL)
 
@@ -52,6 +75,34 @@ class CustomFileChooser(FileChooserIconView):
             # Si ocurre un error al intentar acceder al archivo, ignorarlo
             return False
 
+class FilaBotonVirtual(RecycleDataViewBehavior, Button):
+    """Fila pulsable de ListaVirtual. La clave 'accion' de los datos es la función a llamar al soltar."""
+    accion = ObjectProperty(None, allownone=True)
+
+    def on_release(self):
+        if self.accion:
+            self.accion()
+
+class FilaTextoVirtual(RecycleDataViewBehavior, Label):
+    """Fila de texto de ListaVirtual, alineada a la izquierda y ajustada al ancho."""
+    def __init__(self, **kwargs):
+        super().__init__(halign='left', valign='top', color=(1, 1, 1, 1), **kwargs)
+        self.bind(size=lambda instance, value: setattr(instance, 'text_size', (instance.width, None)))
+
+class ListaVirtual(RecycleView):
+    """
+    Lista virtualizada (RecycleView): solo se crean los widgets de las filas visibles,
+    así el tiempo de apertura y la memoria no dependen del número de filas.
+    Cada elemento de `data` es un diccionario con 'text' (y 'accion' para FilaBotonVirtual).
+    """
+    def __init__(self, viewclass=FilaTextoVirtual, altura_fila=44, **kwargs):
+        super().__init__(**kwargs)
+        layout = RecycleBoxLayout(orientation='vertical', size_hint_y=None, spacing=5,
+                                  default_size=(None, altura_fila), default_size_hint=(1, None))
+        layout.bind(minimum_height=layout.setter('height'))
+        self.add_widget(layout)
+        self.viewclass = viewclass
+
 # Configuración de la ventana
 Window.clearcolor = (0.1, 0.1, 0.1, 1)  # Fondo negro
 Window.size = (650, 399)  # Tamaño inicial de la ventana
@@ -64,32 +115,1231 @@ ENABLE_LOGIN = False
 ENABLE_DYNAMIC_TITLE = True  # Activar o desactivar el título dinámico
 TITLE_UPDATE_INTERVAL = 3  # Intervalo de actualización en segundos
 
+# Variables para configurar el muestreo de recursos (título dinámico y panel de diagnóstico con F12)
+RESOURCE_SAMPLE_INTERVAL = 1  # Intervalo (segundos) entre muestras, tomadas en un hilo en segundo plano
+RESOURCE_SAMPLE_HISTORY = 300  # Número de muestras guardadas (buffer circular)
+
+# Variables para configurar la escritura diferida (write-behind) de REVs/REV-<fecha>.xlsx
+REV_FLUSH_INTERVAL = 5  # Intervalo máximo (segundos) entre guardados del REV xlsx
+REV_FLUSH_BATCH_SIZE = 50  # Número de revisiones pendientes que fuerza un guardado inmediato
+REV_JOURNAL_PATH = os.path.join('REVs', 'revisiones.journal.jsonl')  # Diario (append-only) de revisiones aún no guardadas en db.db
+REV_JOURNAL_REPLAY_INTERVAL = 1  # Intervalo (segundos) para guardar en db.db las revisiones del diario
+REV_JOURNAL_COMPACT_SIZE = 1024 * 1024  # Tamaño (bytes) a partir del cual el diario ya guardado se vacía
+
+# Variables para configurar el índice de revisiones de días anteriores (REVs/REV-*.xlsx)
+REV_INDEX_INTERVAL = 60  # Intervalo (segundos) para buscar REV xlsx nuevos o modificados
+
+# Columnas de los archivos REV xlsx y sus equivalentes en la tabla revisiones
+REV_HEADERS = ['EAN/SKU/ID', 'MARCA/TITULO', 'Tipo', 'Tiene PT', 'Tiene ES', 'Tiene IT', 'Cantidad Neta', 'UND/ML/GR', 'Composición de Lote', 'Estado', 'DescripcionPT', 'Modo de EmpleoPT', 'PrecaucionesPT', 'Más InformacionesPT', 'DescripcionIT', 'Modo de EmpleoIT', 'PrecaucionesIT', 'Más InformacionesIT']
+REV_DB_COLUMNS = ['ean_sku_id', 'marca_titulo', 'tipo', 'tiene_pt', 'tiene_es', 'tiene_it', 'cantidad_neta', 'unidad', 'composicion_lote', 'estado', 'descripcion_pt', 'modo_empleo_pt', 'precauciones_pt', 'mas_informaciones_pt', 'descripcion_it', 'modo_empleo_it', 'precauciones_it', 'mas_informaciones_it']
+
+# Sentencia de inserción de revisiones (una sola vez por uid), pendientes de volcar al REV xlsx
+SQL_INSERTAR_REVISION = f'''INSERT OR IGNORE INTO revisiones (uid, fecha, hora, exportado, {', '.join(REV_DB_COLUMNS)})
+    VALUES (?, ?, ?, 0, {', '.join('?' for _ in REV_DB_COLUMNS)})'''
+
+# Variables para configurar la importación masiva en segundo plano
+ENABLE_WAL = True  # Modo WAL en db.db: las lecturas no se bloquean mientras un hilo escribe (importación, volcados)
+MASS_IMPORT_PROGRESS_HZ = 20  # Actualizaciones máximas por segundo de la barra de progreso
+MASS_IMPORT_CHUNK_SIZE = 1000  # Filas por cada executemany (entre bloques se comprueba la cancelación)
+
+# Columnas del archivo de importación masiva, reconocidas por el nombre del encabezado (sin distinguir mayúsculas ni acentos).
+# SKU, Titulo y EANs son obligatorias (si no hay encabezados reconocibles se leen por posición: A, B, C);
+# el resto son opcionales y, si tienen valor en una fila, sustituyen al valor del formulario para esa fila.
+IMPORT_COLUMNS = {
+    'ean_sku_id': ('sku', 'ean/sku/id'),
+    'marca_titulo': ('titulo', 'marca/titulo'),
+    'eans': ('eans',),
+    'tipo': ('tipo',),
+    'cantidad_neta': ('cantidad neta',),
+    'unidad': ('und/ml/gr', 'unidad'),
+    'estado': ('estado',),
+}
+IMPORT_REQUIRED_COLUMNS = {'ean_sku_id': 'SKU', 'marca_titulo': 'Titulo', 'eans': 'EANs'}
+IMPORT_OVERRIDE_COLUMNS = ['tipo', 'cantidad_neta', 'unidad', 'estado']
+ESTADOS_REVISION = ('Solo Revisión', 'Revisado y Traducido')
+UNIDADES = ('UND', 'ML', 'GR')
+TIPOS_CON_COMPOSICION = ('LOTE', 'Set & Pack')  # Tipos que guardan la composición de lote del formulario
+TIPOS_ESPECIALES = ('ZZ', 'LOTE', 'Set & Pack', 'Consumo', 'EDT & EDP', 'MakeUP')  # Casillas del formulario
+TIPOS_PRODUCTO = ('ACCESSORIES', 'administración', 'AFEITAR AFTER PRESHAVE', 'AFEITAR CREMA ESPUMA BROCHA', 'AFEITAR HOJA MAQUINA BROCHA', 'ALIMENTOS ENVASADOS', 'ALIMENTOS MASCOTAS', 'ALMACEN VARIOS', 'AMBIENTADORES', 'ANEXOS', 'Automatico desde Articulo', 'BAÑO DESODORANTE', 'BAÑO GEL', 'BAÑO JABON', 'BAÑO LECHE BODY L. ACEITE', 'BAÑO TALCO', 'BAÑO-VARIOS', 'BEBIDAS ENVASADAS', 'BEELINE', 'BISUTERIA', 'CABELLO ACONDIC. SUAVIZANTE', 'CABELLO CHAMPU', 'CABELLO FIJADOR BRILLANTINA', 'CABELLO LACA', 'CABELLO TINTES', 'CABELLO TONICO LOCION', 'CHRISTMAS', 'DENTIFRICO', 'DEPILATORIO', 'DESCUENTO PROMO', 'DUPLOS', 'ESTUCHES COLORIDO FLORES', 'ESTUCHES TRATAMIENTO', 'GIFT WRAPPING', 'GRANELES', 'HIGIENE CELULOSA', 'HIGIENE MASCOTAS', 'HOBBY', 'HOME INTERIOR', 'JUEGOS EROTICOS', 'LOTES', 'MAQUILLAJE CUERPO', 'MAQUILLAJE LABIOS', 'MAQUILLAJE MANOS', 'MAQUILLAJE OJOS', 'MAQUILLAJE ROSTRO', 'MAQUILLAJE SURTIDO', 'MATERIAL CONSUMIBLE', 'MATERIAL PLV', 'MATERIAL PLV ESPECIFICO', 'MINIATURAS', 'MUY MUCHO', 'P01', 'PARTY ARTICLES', 'PELUCHES JUGUETES', 'PELUQUERIA FRANCK PROVOST', 'PERF. ESTUCHES HOMBRE', 'PERF. ESTUCHES MUJER', 'PERF.ALC.FEMENINA', 'PERF.ALC.FEMENINA ALMACEN', 'PERF.ALC.INFANTIL', 'PERF.ALC.INFANTIL ALMACEN', 'PERF.ALC.MASCULINA', 'PERF.ALC.MASCULINA ALMACEN', 'PROMOCIONAL FEMENINO ALMACEN', 'PROMOCIONAL MASCULINO ALMACEN', 'PROMOCIONALES FEMENINOS', 'PROMOCIONALES MASCULINOS', 'PRUEBAS EXCEL', 'SEASON', 'STATIONERY', 'SUSCRIPCIONES', 'TARJETAS REGALO DIGITALES', 'TARJETAS REGALO FISICAS', 'TEENS', 'TEXTIL', 'TOYS', 'TRAT.FEMENINO', 'TRAT.MASCULINO', 'TRAT.SOLAR', 'TRATAMIENTO CUERPO MANOS', 'VALE', 'VARIOS', 'VARIOS SIN CODIFICAR', 'VARIOUS ITEMS')  # Lista desplegable de tipos
+
+# Variables para configurar el alta masiva de productos (upsert)
+CATALOG_UPSERT_CHUNK_SIZE = 5000  # Productos por transacción al registrar en bloque
+
+# Variables para configurar el índice EAN/SKU en memoria
+ENABLE_MEMORY_INDEX = True  # Activar o desactivar el índice en memoria
+CATALOG_CHECK_INTERVAL = 2  # Intervalo (segundos) para detectar cambios de db.db hechos por otros procesos
+
+# Variables para configurar el filtro Bloom de códigos inexistentes
+ENABLE_BLOOM_FILTER = True  # Activar o desactivar el filtro Bloom (solo se usa si el índice en memoria está desactivado)
+BLOOM_FALSE_POSITIVE_RATE = 0.01  # Tasa de falsos positivos deseada (0.01 = 1%)
+
+# Variables para configurar la búsqueda MARCA/TITULO mientras se escribe
+ENABLE_SEARCH_AS_YOU_TYPE = True  # Activar o desactivar las sugerencias en vivo
+SUGGESTIONS_DEBOUNCE = 0.3  # Segundos sin pulsaciones antes de lanzar la búsqueda
+SUGGESTIONS_MIN_CHARS = 3  # Longitud mínima del texto para buscar
+SUGGESTIONS_LIMIT = 10  # Número máximo de sugerencias
+
+# Caracteres que se quitan al principio y al final de cada EAN: espacio y caracteres de control
+ESPACIOS_EAN = ''.join(chr(codigo) for codigo in range(1, 33))
+
+def sql_lista_eans(columna):
+    """
+    Devuelve una expresión SQL que convierte la lista de EANs separados por coma
+    (o por saltos de línea/tabuladores) de la columna indicada en un array JSON para json_each().
+    json_quote escapa comillas, barras y el resto de caracteres de control, así que el array siempre es válido.
+    Los valores deben limpiarse con sql_ean().
+    """
+    texto = f"replace(replace(replace(coalesce({columna}, ''), char(13), ','), char(10), ','), char(9), ',')"
+    return f"('[' || replace(json_quote({texto}), ',', '\",\"') || ']')"
+
+def sql_ean(valor):
+    """Expresión SQL que quita espacios y caracteres de control al principio y al final de un EAN (como dividir_eans)."""
+    return f"trim({valor}, char({', '.join(str(ord(c)) for c in ESPACIOS_EAN)}))"
+
+def ruta_rev(fecha):
+    """Ruta del archivo REV xlsx de una fecha ISO (YYYY-MM-DD)."""
+    return f"REVs/REV-{datetime.strptime(fecha, '%Y-%m-%d').strftime('%d-%m-%Y')}.xlsx"
+
+def fecha_de_archivo_rev(nombre):
+    """Fecha ISO (YYYY-MM-DD) de un archivo REV-dd-mm-YYYY.xlsx, o None si el nombre no tiene ese formato."""
+    try:
+        return datetime.strptime(os.path.basename(nombre), 'REV-%d-%m-%Y.xlsx').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+def _xml_hoja_activa(zf):
+    """Ruta dentro del zip de la primera hoja del libro (la que usan los REV xlsx)."""
+    try:
+        libro = ET.fromstring(zf.read('xl/workbook.xml'))
+        rid = libro.find(f'{XLSX_NS}sheets/{XLSX_NS}sheet').get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id')
+        for relacion in ET.fromstring(zf.read('xl/_rels/workbook.xml.rels')):
+            if relacion.get('Id') == rid:
+                destino = relacion.get('Target')
+                return destino.lstrip('/') if destino.startswith('/') else 'xl/' + destino
+    except (KeyError, AttributeError, ET.ParseError):
+        pass
+    return 'xl/worksheets/sheet1.xml'
+
+def _cadenas_compartidas(zf, indices):
+    """Lee de xl/sharedStrings.xml solo las cadenas con los índices pedidos (se detiene al pasar el mayor)."""
+    cadenas = {}
+    if not indices or 'xl/sharedStrings.xml' not in zf.namelist():
+        return cadenas
+    maximo = max(indices)
+    with zf.open('xl/sharedStrings.xml') as archivo:
+        indice = 0
+        for evento, elemento in ET.iterparse(archivo):
+            if elemento.tag != f'{XLSX_NS}si':
+                continue
+            if indice in indices:
+                cadenas[indice] = ''.join(t.text or '' for t in elemento.iter(f'{XLSX_NS}t'))
+            elemento.clear()
+            if indice >= maximo:
+                break
+            indice += 1
+    return cadenas
+
+def _columna_celda(referencia):
+    columna = 0
+    for letra in re.match(r'[A-Z]*', referencia or '').group():
+        columna = columna * 26 + ord(letra) - 64
+    return columna
+
+def leer_ultimas_filas_xlsx(ruta, cantidad):
+    """
+    Devuelve las últimas `cantidad` filas de la primera hoja de un xlsx como lista de (número de fila, valores),
+    en el orden del archivo, sin parsear toda la hoja: descomprime el XML de la hoja por bloques guardando
+    solo los últimos <row>, y después decodifica esas filas y las cadenas compartidas que referencian.
+    """
+    with zipfile.ZipFile(ruta) as zf:
+        ultimas = deque(maxlen=cantidad)
+        resto = b''
+        with zf.open(_xml_hoja_activa(zf)) as hoja:
+            while True:
+                bloque = hoja.read(1 << 20)
+                if not bloque:
+                    break
+                partes = (resto + bloque).split(b'</row>')
+                resto = partes.pop()
+                for parte in partes:
+                    inicio = max(parte.rfind(b'<row '), parte.rfind(b'<row>'))
+                    if inicio >= 0:
+                        ultimas.append(parte[inicio:] + b'</row>')
+        if not ultimas:
+            return []
+        filas_xml = ET.fromstring(f'<sheetData xmlns="{XLSX_NS[1:-1]}">'.encode() + b''.join(ultimas) + b'</sheetData>')
+
+        filas = []
+        compartidas = set()
+        for numero, fila_xml in enumerate(filas_xml):
+            celdas = []
+            for posicion, celda in enumerate(fila_xml.iter(f'{XLSX_NS}c'), start=1):
+                columna = _columna_celda(celda.get('r')) or posicion
+                tipo = celda.get('t', 'n')
+                valor = celda.findtext(f'{XLSX_NS}v')
+                if tipo == 'inlineStr':
+                    valor = ''.join(t.text or '' for t in celda.iter(f'{XLSX_NS}t'))
+                elif tipo == 's' and valor is not None:
+                    valor = int(valor)
+                    compartidas.add(valor)
+                elif tipo == 'b' and valor is not None:
+                    valor = valor == '1'
+                elif tipo == 'n' and valor is not None:
+                    numero_celda = float(valor)
+                    valor = int(numero_celda) if numero_celda.is_integer() else numero_celda
+                celdas.append((columna, tipo, valor))
+            filas.append((int(fila_xml.get('r', numero + 1)), celdas))
+
+        cadenas = _cadenas_compartidas(zf, compartidas)
+    resultado = []
+    for numero, celdas in filas:
+        valores = [None] * max((columna for columna, _, _ in celdas), default=0)
+        for columna, tipo, valor in celdas:
+            valores[columna - 1] = cadenas.get(valor) if tipo == 's' else valor
+        resultado.append((numero, tuple(valores)))
+    return resultado
+
+def filas_archivo_rev(ruta):
+    """
+    Lee una sola vez un REV xlsx (openpyxl read-only, solo valores) y devuelve sus filas de datos (sin encabezado)
+    como tuplas (número de fila en la hoja, textos con las columnas de REV_DB_COLUMNS, valores numéricos):
+    los valores numéricos son una lista JSON con los números de la fila y null en las demás celdas, o None si no tiene.
+    """
+    wb = load_workbook(ruta, read_only=True)
+    try:
+        filas = []
+        for numero, row in enumerate(islice(wb.active.iter_rows(values_only=True), 1, None), start=2):
+            if not row or row[0] is None:
+                continue
+            valores = (list(row) + [None] * len(REV_DB_COLUMNS))[:len(REV_DB_COLUMNS)]
+            numeros = [valor if isinstance(valor, (int, float)) and not isinstance(valor, bool) else None for valor in valores]
+            filas.append((numero, [('' if valor is None else str(valor).strip()) for valor in valores],
+                          json.dumps(numeros) if any(valor is not None for valor in numeros) else None))
+        return filas
+    finally:
+        wb.close()
+
+def insertar_filas_archivo(conn, filas, fecha, nombre):
+    """Inserta en revisiones filas de filas_archivo_rev (ya exportadas, con su posición en la hoja y sus números)."""
+    conn.executemany(
+        f'''INSERT INTO revisiones (fecha, hora, exportado, archivo, posicion, valores, {', '.join(REV_DB_COLUMNS)})
+            VALUES (?, '', 1, ?, ?, ?, {', '.join('?' for _ in REV_DB_COLUMNS)})''',
+        ([fecha, nombre, numero, numeros] + fila for numero, fila, numeros in filas))
+
+def incorporar_filas_ajenas(conn, filas, fecha, nombre):
+    """
+    Incorpora a la tabla revisiones (columna archivo = nombre del archivo) las filas del REV xlsx de la fecha que
+    la tabla no tiene: las añadidas por main.py o a mano en un archivo que la aplicación también escribe.
+    Las filas se comparan por sus valores (cada fila de la tabla empareja una sola fila del archivo) y todas las
+    que están en el archivo toman su posición en la hoja, para regenerarlo en el mismo orden; las demás
+    (pendientes de volcar) quedan sin posición y van detrás. Debe llamarse dentro de una transacción.
+    Devuelve el número de filas incorporadas.
+    """
+    conocidas = {}  # Valores -> ids de las filas de la tabla con esos valores, en el orden actual del archivo
+    for id_revision, *valores in conn.execute(
+            f'SELECT id, {", ".join(REV_DB_COLUMNS)} FROM revisiones WHERE fecha = ? ORDER BY posicion IS NULL, posicion, id', (fecha,)):
+        conocidas.setdefault(tuple('' if valor is None else str(valor).strip() for valor in valores), deque()).append(id_revision)
+    posiciones = []
+    ajenas = []
+    for numero, fila, numeros in filas:
+        ids = conocidas.get(tuple(fila))
+        if ids:
+            posiciones.append((numero, ids.popleft()))
+        else:
+            ajenas.append((numero, fila, numeros))
+    conn.execute('UPDATE revisiones SET posicion = NULL WHERE fecha = ? AND posicion IS NOT NULL', (fecha,))
+    conn.executemany('UPDATE revisiones SET posicion = ? WHERE id = ?', posiciones)
+    insertar_filas_archivo(conn, ajenas, fecha, nombre)
+    return len(ajenas)
+
+def registrar_archivo_rev(conn, ruta, fecha):
+    """Guarda en archivos_rev el mtime y el tamaño actuales del REV xlsx (versión ya incorporada a la tabla)."""
+    estado = os.stat(ruta)
+    conn.execute('''INSERT INTO archivos_rev (archivo, fecha, mtime_ns, tamano) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(archivo) DO UPDATE SET fecha = excluded.fecha, mtime_ns = excluded.mtime_ns, tamano = excluded.tamano''',
+                 (os.path.basename(ruta), fecha, estado.st_mtime_ns, estado.st_size))
+
+def archivo_rev_modificado(conn, ruta):
+    """True si el REV xlsx existe y cambió desde la última vez que se incorporó o se escribió (archivos_rev)."""
+    if not os.path.exists(ruta):
+        return False
+    estado = os.stat(ruta)
+    registrado = conn.execute('SELECT mtime_ns, tamano FROM archivos_rev WHERE archivo = ?', (os.path.basename(ruta),)).fetchone()
+    return registrado != (estado.st_mtime_ns, estado.st_size)
+
+def indexar_archivo_rev(conn, ruta, fecha):
+    """
+    Incorpora las filas de un REV xlsx a la tabla revisiones (columna archivo = nombre del archivo) y
+    guarda su mtime/tamaño en archivos_rev. Si la fecha ya tiene revisiones registradas en la aplicación,
+    el archivo se genera desde la tabla y solo se incorporan las filas que la tabla no tiene
+    (incorporar_filas_ajenas). Devuelve True si cambiaron las revisiones.
+    """
+    nombre = os.path.basename(ruta)
+    filas = filas_archivo_rev(ruta)
+    conn.execute('BEGIN IMMEDIATE')  # EscritorREV puede estar incorporando el mismo archivo
+    try:
+        if conn.execute('SELECT 1 FROM revisiones WHERE fecha = ? AND archivo IS NULL LIMIT 1', (fecha,)).fetchone():
+            cambiado = incorporar_filas_ajenas(conn, filas, fecha, nombre) > 0
+        else:
+            conn.execute('DELETE FROM revisiones WHERE fecha = ? AND archivo IS NOT NULL', (fecha,))
+            insertar_filas_archivo(conn, filas, fecha, nombre)
+            cambiado = True
+        registrar_archivo_rev(conn, ruta, fecha)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return cambiado
+
+def normalizar_texto(texto):
+    """Texto en minúsculas, sin acentos ni espacios sobrantes (para comparar encabezados y valores)."""
+    texto = unicodedata.normalize('NFKD', str(texto).strip().lower())
+    return ' '.join(''.join(c for c in texto if not unicodedata.combining(c)).split())
+
+def mapear_columnas(encabezados):
+    """
+    Devuelve {campo: índice de columna} para los campos de IMPORT_COLUMNS presentes en los encabezados.
+    Si no se reconoce ningún encabezado, se asume el formato antiguo (SKU, Titulo, EANs por posición); si se reconoce
+    alguno pero falta una columna obligatoria, lanza ValueError en lugar de leer datos de la columna equivocada.
+    """
+    nombres = [normalizar_texto(h) if h is not None else '' for h in encabezados]
+    columnas = {}
+    for campo, alias in IMPORT_COLUMNS.items():
+        for nombre in alias:
+            if nombre in nombres:
+                columnas[campo] = nombres.index(nombre)
+                break
+    if not columnas:
+        return {'ean_sku_id': 0, 'marca_titulo': 1, 'eans': 2}
+    faltan = [nombre for campo, nombre in IMPORT_REQUIRED_COLUMNS.items() if campo not in columnas]
+    if faltan:
+        raise ValueError(f'Faltan columnas obligatorias en el encabezado: {", ".join(faltan)}')
+    return columnas
+
+def valor_celda(row, indice):
+    """Valor de la columna `indice` de una fila, o None si la columna no existe o la celda está vacía."""
+    if indice is None or indice >= len(row):
+        return None
+    valor = row[indice]
+    if valor is None or (isinstance(valor, str) and not valor.strip()):
+        return None
+    return valor
+
+def dividir_eans(eans):
+    """Divide una lista de EANs separados por coma (o saltos de línea/tabuladores) en EANs normalizados."""
+    if eans is None:
+        return []
+    texto = str(eans).replace('\r', ',').replace('\n', ',').replace('\t', ',')
+    return [ean.strip(ESPACIOS_EAN) for ean in texto.split(',') if ean.strip(ESPACIOS_EAN)]
+
+class IndiceEANMemoria:
+    """
+    Índice en memoria del catálogo: EAN normalizado -> tupla de SKUs y SKU -> título.
+    Se construye desde db.db en segundo plano (construir_caches_catalogo) y se actualiza en el sitio al añadir productos.
+    """
+    def __init__(self):
+        self.por_ean = {}
+        self.titulos = {}
+        self.build_time = 0.0  # Segundos que tardó la última construcción
+        self.memoria = 0  # Bytes estimados tras construir (memoria_bytes recorre todo el índice: no en el hilo de Kivy)
+
+    @staticmethod
+    def normalizar(codigo):
+        return str(codigo).strip()
+
+    def construir(self, cursor):
+        inicio = time.perf_counter()
+        self.titulos = {sku: titulo for sku, titulo in cursor.execute('SELECT sku, titulo FROM productos')}
+        por_ean = {}
+        for ean, sku in cursor.execute('SELECT ean, sku FROM product_eans ORDER BY ean'):
+            skus = por_ean.get(ean)
+            por_ean[ean] = skus + (sku,) if skus else (sku,)
+        self.por_ean = por_ean
+        self.build_time = time.perf_counter() - inicio
+
+    def buscar(self, codigo):
+        """Devuelve una lista de tuplas (sku, titulo), igual que search_product_in_db."""
+        codigo = self.normalizar(codigo)
+        if codigo in self.titulos:
+            return [(codigo, self.titulos[codigo])]
+        return [(sku, self.titulos.get(sku)) for sku in self.por_ean.get(codigo, ())]
+
+    def agregar_producto(self, sku, titulo, eans):
+        sku = self.normalizar(sku)
+        self.titulos[sku] = titulo
+        for ean in dividir_eans(eans):
+            skus = self.por_ean.get(ean, ())
+            if sku not in skus:
+                self.por_ean[ean] = skus + (sku,)
+
+    def memoria_bytes(self):
+        """Estimación de la memoria ocupada por el índice (diccionarios, claves y valores)."""
+        total = sys.getsizeof(self.por_ean) + sys.getsizeof(self.titulos)
+        for ean, skus in self.por_ean.items():
+            total += sys.getsizeof(ean) + sys.getsizeof(skus)
+        for sku, titulo in self.titulos.items():
+            total += sys.getsizeof(sku) + sys.getsizeof(titulo)
+        return total
+
+class FiltroBloom:
+    """
+    Conjunto probabilístico compacto de SKUs y EANs conocidos.
+    Si un código no está en el filtro, seguro que no existe en el catálogo;
+    si está, puede existir (con la tasa de falsos positivos configurada).
+    """
+    def __init__(self, capacidad, tasa_falsos_positivos=BLOOM_FALSE_POSITIVE_RATE):
+        self.capacidad = max(int(capacidad), 1000)
+        self.tasa_falsos_positivos = tasa_falsos_positivos
+        self.num_bits = int(-self.capacidad * math.log(tasa_falsos_positivos) / (math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / self.capacidad * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.elementos = 0
+
+    def _posiciones(self, codigo):
+        digest = hashlib.blake2b(str(codigo).strip().encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def agregar(self, codigo):
+        for posicion in self._posiciones(codigo):
+            self.bits[posicion >> 3] |= 1 << (posicion & 7)
+        self.elementos += 1
+
+    def __contains__(self, codigo):
+        return all(self.bits[posicion >> 3] & (1 << (posicion & 7)) for posicion in self._posiciones(codigo))
+
+    @property
+    def saturado(self):
+        return self.elementos > self.capacidad
+
+    @classmethod
+    def desde_db(cls, cursor, tasa_falsos_positivos=BLOOM_FALSE_POSITIVE_RATE):
+        """Construye el filtro con todos los SKUs de productos y EANs de product_eans."""
+        total = cursor.execute('SELECT (SELECT COUNT(*) FROM productos) + (SELECT COUNT(*) FROM product_eans)').fetchone()[0]
+        filtro = cls(total * 2, tasa_falsos_positivos)  # Margen para los productos añadidos después
+        for (codigo,) in cursor.execute('SELECT sku FROM productos UNION ALL SELECT ean FROM product_eans'):
+            filtro.agregar(codigo)
+        return filtro
+
+def leer_version_catalogo(cursor):
+    """Contador de cambios del catálogo (tabla catalogo_version, incrementada por los triggers de productos)."""
+    return cursor.execute('SELECT version FROM catalogo_version WHERE id = 1').fetchone()[0]
+
+def construir_caches_catalogo(db_path='db.db'):
+    """
+    Construye, con una conexión propia (para usar fuera del hilo principal), el índice EAN/SKU en memoria
+    o, si está desactivado, el filtro Bloom. Devuelve (versión del catálogo, índice o None, filtro o None).
+    La versión se lee antes de construir: si el catálogo cambia mientras tanto, se detectará otra vez.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        version = leer_version_catalogo(cursor)
+        indice = None
+        if ENABLE_MEMORY_INDEX:
+            indice = IndiceEANMemoria()
+            indice.construir(cursor)
+            indice.memoria = indice.memoria_bytes()
+        # Con el índice en memoria el filtro Bloom no aporta nada: el índice ya responde sin consultar la DB
+        filtro = FiltroBloom.desde_db(cursor) if ENABLE_BLOOM_FILTER and indice is None else None
+        return version, indice, filtro
+    finally:
+        conn.close()
+
+class BuscadorSugerencias:
+    """
+    Ejecuta las búsquedas MARCA/TITULO en un hilo en segundo plano con su propia conexión a db.db.
+    Solo se atiende la búsqueda más reciente: las anteriores se cancelan con sqlite3.Connection.interrupt().
+    Los resultados se entregan en el hilo principal de Kivy mediante Clock.
+    """
+    def __init__(self, buscar, on_resultados, db_path='db.db'):
+        self.buscar = buscar  # Función (cursor, keywords, limit) -> lista de (sku, titulo)
+        self.on_resultados = on_resultados  # Función (texto, resultados) llamada en el hilo principal
+        self.db_path = db_path
+        self.condicion = threading.Condition()
+        self.pendiente = None  # (generación, texto) de la próxima búsqueda
+        self.generacion = 0
+        self.ocupado = False
+        self.activo = True
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.hilo = threading.Thread(target=self._bucle, name='BuscadorSugerencias', daemon=True)
+        self.hilo.start()
+
+    def solicitar(self, texto):
+        with self.condicion:
+            self.generacion += 1
+            self.pendiente = (self.generacion, texto)
+            self.condicion.notify()
+            if self.ocupado:
+                self.conn.interrupt()
+
+    def cancelar(self):
+        with self.condicion:
+            self.generacion += 1
+            self.pendiente = None
+            if self.ocupado:
+                self.conn.interrupt()
+
+    def detener(self):
+        with self.condicion:
+            self.activo = False
+            self.condicion.notify()
+            if self.ocupado:
+                self.conn.interrupt()
+
+    def _bucle(self):
+        cursor = self.conn.cursor()
+        while True:
+            with self.condicion:
+                while self.pendiente is None and self.activo:
+                    self.condicion.wait()
+                if not self.activo:
+                    break
+                generacion, texto = self.pendiente
+                self.pendiente = None
+                self.ocupado = True
+            try:
+                resultados = self.buscar(texto.split(), cursor=cursor, limit=SUGGESTIONS_LIMIT)
+            except sqlite3.OperationalError as e:
+                with self.condicion:
+                    # Si la interrupción iba dirigida a una búsqueda anterior, repetir esta
+                    if "interrupted" in str(e) and self.pendiente is None and generacion == self.generacion:
+                        self.pendiente = (generacion, texto)
+                continue
+            finally:
+                with self.condicion:
+                    self.ocupado = False
+            if generacion == self.generacion:
+                Clock.schedule_once(lambda dt, t=texto, r=resultados: self.on_resultados(t, r))
+        self.conn.close()
+
+class ResultadosPaginados:
+    """
+    Secuencia perezosa de resultados (sku, titulo) de una búsqueda, formada por niveles consecutivos.
+    Cada nivel es (sql, parametros, por_fila): la consulta devuelve la columna fila (rowid de productos).
+    - Nivel ordenado por relevancia (por_fila False): el orden lo da la consulta. El primer bloque se lee con LIMIT;
+      para los siguientes se leen una sola vez todas sus filas (solo los rowid, en un array).
+    - Nivel por_fila: ordenado por rowid y paginado con la clave fila > ?, que pueden resolver los índices.
+      Se saltan las filas que ya salieron en los niveles ordenados anteriores.
+    Los títulos se leen solo para el bloque pedido, y el total (COUNT) solo cuando se pide len().
+    """
+    def __init__(self, conn, niveles, tamano_bloque):
+        self.conn = conn
+        self.niveles = [(sql, list(parametros), por_fila) for sql, parametros, por_fila in niveles]
+        self.tamano_bloque = tamano_bloque
+        self.rankings = {}  # Nivel ordenado -> array de rowid en su orden
+        self.prefijos = {}  # Nivel ordenado -> primeras filas (leídas con LIMIT) mientras no se lee entero
+        self.tamanos = {}  # Nivel -> número de resultados
+        self.excluidas = {}  # Nivel por_fila -> conjunto de filas de los niveles ordenados anteriores
+        self.claves = {0: (0, None)}  # Posición -> (nivel, clave dentro del nivel: índice en el ranking o última fila)
+        self.ultimo = None  # (inicio, cantidad, resultados) del último bloque leído
+
+    def _ranking(self, nivel, hasta=None):
+        """
+        Filas de un nivel ordenado. Con `hasta`, basta con las primeras `hasta`: si caben en el primer bloque
+        (más una, para saber si hay más) se leen con LIMIT, que es mucho más rápido que ordenar el nivel entero.
+        """
+        if nivel in self.rankings:
+            return self.rankings[nivel]
+        if hasta is not None and hasta <= len(self.prefijos.get(nivel, ())):
+            return self.prefijos[nivel]
+        sql, parametros, _ = self.niveles[nivel]
+        limite = self.tamano_bloque + 1
+        if hasta is not None and hasta <= limite and nivel not in self.prefijos:
+            filas = array('q', (fila for fila, in self.conn.execute(f'{sql} LIMIT ?', parametros + [limite])))
+            if len(filas) == limite:
+                self.prefijos[nivel] = filas
+                return filas
+        else:
+            filas = array('q', (fila for fila, in self.conn.execute(sql, parametros)))
+        self.rankings[nivel] = filas
+        return filas
+
+    def _excluidas(self, nivel):
+        """Filas de los niveles ordenados anteriores a `nivel`, que un nivel por_fila no repite."""
+        if nivel not in self.excluidas:
+            self.excluidas[nivel] = set()
+            for anterior in range(nivel):
+                if not self.niveles[anterior][2]:
+                    self.excluidas[nivel].update(self._ranking(anterior))
+        return self.excluidas[nivel]
+
+    def _filas_nivel(self, nivel, desde, cantidad):
+        """Hasta `cantidad` filas de un nivel por_fila posteriores a `desde` (None: desde el principio)."""
+        sql, parametros, _ = self.niveles[nivel]
+        excluidas = self._excluidas(nivel)
+        filas = []
+        while len(filas) < cantidad:
+            # Si hay filas que saltar se leen más de las que faltan para no repetir la consulta por cada una
+            lote = max(cantidad - len(filas), EXPORT_FETCH_SIZE) if excluidas else cantidad - len(filas)
+            if desde is None:
+                leidas = self.conn.execute(f'SELECT fila FROM ({sql}) ORDER BY fila LIMIT ?', parametros + [lote]).fetchall()
+            else:
+                leidas = self.conn.execute(f'SELECT fila FROM ({sql}) WHERE fila > ? ORDER BY fila LIMIT ?',
+                                           parametros + [desde, lote]).fetchall()
+            for fila, in leidas:
+                desde = fila
+                if fila not in excluidas:
+                    filas.append(fila)
+                    if len(filas) == cantidad:
+                        break
+            if len(leidas) < lote:
+                break
+        return filas
+
+    def _tamano(self, nivel):
+        if nivel not in self.tamanos:
+            sql, parametros, por_fila = self.niveles[nivel]
+            if not por_fila:
+                self.tamanos[nivel] = len(self._ranking(nivel))
+            elif self._excluidas(nivel):
+                excluidas = self._excluidas(nivel)
+                self.tamanos[nivel] = sum(fila not in excluidas for fila, in self.conn.execute(sql, parametros))
+            else:
+                self.tamanos[nivel] = self.conn.execute(f'SELECT COUNT(*) FROM ({sql})', parametros).fetchone()[0]
+        return self.tamanos[nivel]
+
+    def __len__(self):
+        return sum(self._tamano(nivel) for nivel in range(len(self.niveles)))
+
+    def __bool__(self):
+        return bool(self[0:self.tamano_bloque])  # El primer bloque suele estar ya leído
+
+    def _clave(self, inicio):
+        """Clave de la posición `inicio` cuando no se llegó a ella leyendo bloques consecutivos (salto)."""
+        base = 0
+        for nivel, (sql, parametros, por_fila) in enumerate(self.niveles):
+            tamano = self._tamano(nivel)
+            if inicio < base + tamano:
+                desplazamiento = inicio - base
+                if not por_fila:
+                    return nivel, desplazamiento
+                if desplazamiento == 0:
+                    return nivel, None
+                return nivel, self._filas_nivel(nivel, None, desplazamiento)[-1]
+            base += tamano
+        return len(self.niveles), None
+
+    def _leer(self, inicio, cantidad):
+        """Lee `cantidad` resultados desde la posición `inicio` y recuerda la clave del siguiente bloque."""
+        if self.ultimo and self.ultimo[:2] == (inicio, cantidad):
+            return self.ultimo[2]
+        nivel, desde = self.claves[inicio] if inicio in self.claves else self._clave(inicio)
+        filas = []
+        while nivel < len(self.niveles) and len(filas) < cantidad:
+            faltan = cantidad - len(filas)
+            if self.niveles[nivel][2]:
+                lote = self._filas_nivel(nivel, desde, faltan)
+                siguiente = lote[-1] if lote else desde
+            else:
+                desde = desde or 0
+                lote = self._ranking(nivel, desde + faltan)[desde:desde + faltan]
+                siguiente = desde + len(lote)
+            filas.extend(lote)
+            if len(lote) < faltan:
+                nivel, desde = nivel + 1, None
+            else:
+                desde = siguiente
+        self.claves[inicio + len(filas)] = (nivel, desde)
+        titulos = {fila: (sku, titulo) for fila, sku, titulo in self.conn.execute(
+            'SELECT rowid, sku, titulo FROM productos WHERE rowid IN (SELECT value FROM json_each(?))', (json.dumps(filas),))}
+        resultados = [titulos[fila] for fila in filas if fila in titulos]
+        self.ultimo = (inicio, cantidad, resultados)
+        return resultados
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step not in (None, 1):
+                raise ValueError('ResultadosPaginados solo admite cortes consecutivos')
+            inicio, fin = item.start or 0, item.stop
+            if inicio < 0 or fin is None or fin < 0:
+                inicio, fin, _ = item.indices(len(self))
+            return self._leer(inicio, fin - inicio) if fin > inicio else []
+        if item < 0:
+            item += len(self)
+        filas = self._leer(item, 1)
+        if not filas:
+            raise IndexError(item)
+        return filas[0]
+
+    def __iter__(self):
+        inicio = 0
+        while True:
+            bloque = self._leer(inicio, self.tamano_bloque)
+            yield from bloque
+            if len(bloque) < self.tamano_bloque:
+                return
+            inicio += len(bloque)
+
+class DiarioRevisiones:
+    """
+    Diario append-only (una línea JSON por revisión, con fsync) para no perder escaneos si la aplicación
+    se cierra o la base de datos está bloqueada. Registrar una revisión solo escribe aquí; las líneas se
+    reproducen después en la tabla revisiones (INSERT OR IGNORE por uid). El diario recuerda hasta dónde
+    está guardado y solo se vacía al iniciar, al cerrar o cuando supera REV_JOURNAL_COMPACT_SIZE.
+    """
+    def __init__(self, ruta=REV_JOURNAL_PATH):
+        directorio = os.path.dirname(ruta)
+        if directorio and not os.path.exists(directorio):
+            os.makedirs(directorio)
+        self.ruta = ruta
+        self._reparar()
+        self.archivo = open(ruta, 'a+', encoding='utf-8')
+        self.guardado = 0  # Posición hasta la que las líneas ya están guardadas en la tabla revisiones
+
+    def _reparar(self):
+        """
+        Descarta una última línea incompleta (escritura cortada por un cierre inesperado); si no, la siguiente
+        línea se escribiría a continuación del fragmento y las dos quedarían ilegibles.
+        """
+        if not os.path.exists(self.ruta):
+            return
+        with open(self.ruta, 'r+b') as archivo:
+            datos = archivo.read()
+            if datos and not datos.endswith(b'\n'):
+                fin = datos.rfind(b'\n') + 1
+                print(f"Diario de revisiones: se descarta una línea incompleta ({len(datos) - fin} bytes)")
+                archivo.truncate(fin)
+                archivo.flush()
+                os.fsync(archivo.fileno())
+
+    def agregar(self, registros):
+        for registro in registros:
+            self.archivo.write(json.dumps(registro, ensure_ascii=False) + '\n')
+        self.archivo.flush()
+        os.fsync(self.archivo.fileno())
+
+    def leer(self):
+        """
+        Devuelve (registros aún no guardados, posición final). Una última línea incompleta (escritura cortada)
+        no se lee ni se da por guardada.
+        """
+        if self.archivo.closed:
+            return [], self.guardado
+        self.archivo.seek(self.guardado)
+        registros = []
+        posicion = self.guardado
+        while True:
+            linea = self.archivo.readline()
+            if not linea.endswith('\n'):
+                break
+            posicion = self.archivo.tell()
+            try:
+                registros.append(json.loads(linea))
+            except ValueError:
+                print(f"Línea del diario de revisiones ignorada: {linea[:80]!r}")
+        return registros, posicion
+
+    def registros_pendientes(self):
+        return self.leer()[0]
+
+    def pendientes(self):
+        if self.archivo.closed:
+            return False
+        return os.fstat(self.archivo.fileno()).st_size > self.guardado
+
+    def marcar_guardado(self, posicion):
+        """Las líneas hasta `posicion` ya están en la tabla revisiones; vacía el diario si ha crecido demasiado."""
+        self.guardado = posicion
+        if posicion >= REV_JOURNAL_COMPACT_SIZE and not self.pendientes():
+            self.vaciar()
+
+    def vaciar(self):
+        """Vacía el diario; solo debe llamarse con todas sus líneas guardadas."""
+        self.archivo.seek(0)
+        self.archivo.truncate()
+        os.fsync(self.archivo.fileno())
+        self.guardado = 0
+
+    def cerrar(self):
+        self.archivo.close()
+
+class IndexadorREV:
+    """
+    Hilo en segundo plano que incorpora a la tabla revisiones todos los REVs/REV-*.xlsx de días anteriores
+    (una sola vez) y después solo los archivos nuevos o modificados (según mtime y tamaño en archivos_rev),
+    para poder consultar al instante la última revisión de cualquier producto.
+    """
+    def __init__(self, db_path='db.db', intervalo=REV_INDEX_INTERVAL, on_cambio=None):
+        self.db_path = db_path
+        self.intervalo = intervalo
+        self.on_cambio = on_cambio  # Función (fechas) llamada en el hilo principal si cambiaron revisiones
+        self.evento = threading.Event()
+        self.hilo = threading.Thread(target=self._bucle, name='IndexadorREV', daemon=True)
+        self.hilo.start()
+
+    def detener(self):
+        self.evento.set()
+        self.hilo.join(5)
+
+    def _bucle(self):
+        conn = sqlite3.connect(self.db_path)
+        while True:
+            self._indexar(conn)
+            if self.evento.wait(self.intervalo):
+                break
+        conn.close()
+
+    def _indexar(self, conn):
+        try:
+            conocidos = {archivo: (mtime_ns, tamano) for archivo, mtime_ns, tamano in conn.execute('SELECT archivo, mtime_ns, tamano FROM archivos_rev')}
+        except sqlite3.OperationalError as e:
+            print(f"Error al leer el índice de REV xlsx: {e}")
+            return
+        cambiadas = []
+        for ruta in sorted(glob.glob(os.path.join('REVs', 'REV-*.xlsx'))):
+            if self.evento.is_set():
+                break
+            fecha = fecha_de_archivo_rev(ruta)
+            if fecha is None:
+                continue
+            try:
+                estado = os.stat(ruta)
+                if conocidos.get(os.path.basename(ruta)) == (estado.st_mtime_ns, estado.st_size):
+                    continue
+                if indexar_archivo_rev(conn, ruta, fecha):
+                    cambiadas.append(fecha)
+            except Exception as e:
+                # Archivo abierto, corrupto o bloqueado: se reintentará en la siguiente pasada
+                conn.rollback()
+                print(f"Error al indexar '{ruta}': {e}")
+        if cambiadas and self.on_cambio:
+            Clock.schedule_once(lambda dt: self.on_cambio(cambiadas))
+
+class ArchivoImportacion:
+    """
+    Archivo xlsx de importación masiva leído una sola vez (openpyxl read-only, solo valores).
+    Guarda los encabezados, las filas y el resultado de la verificación contra la base de datos,
+    y se comparte entre todas las etapas: verificación, confirmación e importación.
+    Las filas completamente vacías (openpyxl las devuelve si tienen formato) se descartan al leer.
+    """
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.filas = []
+        self.numeros = []  # Número de fila en la hoja de cada fila de self.filas (para los mensajes)
+        wb = load_workbook(ruta, read_only=True)
+        try:
+            filas = wb.active.iter_rows(values_only=True)
+            self.encabezados = next(filas, ())
+            for numero, row in enumerate(filas, start=2):
+                if any(valor_celda(row, i) is not None for i in range(len(row))):
+                    self.filas.append(row)
+                    self.numeros.append(numero)
+        finally:
+            wb.close()
+        self.columnas = mapear_columnas(self.encabezados)  # campo de IMPORT_COLUMNS -> índice de columna
+        self.sobrescrituras = [campo for campo in IMPORT_OVERRIDE_COLUMNS if campo in self.columnas]
+        self.faltantes = None  # Productos (sku, titulo, eans) que no están en la base de datos
+        self.coincidencias_ean = {}  # sku no encontrado -> SKUs de la DB que ya tienen alguno de sus EANs
+        self.titulos_distintos = []  # (sku, título del archivo, título en la DB)
+        self.encontrados = 0  # Filas cuyo SKU ya existe en la DB
+
+    def __len__(self):
+        return len(self.filas)
+
+    def producto(self, row):
+        """(sku, titulo, eans) de una fila, según las columnas mapeadas por encabezado."""
+        return (valor_celda(row, self.columnas.get('ean_sku_id')), valor_celda(row, self.columnas.get('marca_titulo')),
+                valor_celda(row, self.columnas.get('eans')))
+
+class ImportacionMasiva:
+    """
+    Importación masiva de revisiones de un ArchivoImportacion en un hilo en segundo plano, con su propia conexión
+    y en una sola transacción: si se cancela, se deshace todo (rollback). Los valores del formulario se leen una
+    sola vez; las columnas opcionales del archivo (Tipo, Cantidad Neta, UND/ML/GR, Estado) los sustituyen fila a fila.
+    Todas las filas se construyen en una pasada y se insertan por bloques de MASS_IMPORT_CHUNK_SIZE.
+    El progreso se envía al hilo principal como máximo MASS_IMPORT_PROGRESS_HZ veces por segundo.
+    """
+    def __init__(self, importacion, estado, formulario, db_path='db.db', on_progreso=None, on_fin=None):
+        self.importacion = importacion
+        self.estado = estado
+        self.formulario = formulario  # Valores del formulario, leídos una vez en el hilo principal
+        self.total = len(importacion)
+        self.db_path = db_path
+        self.on_progreso = on_progreso  # Función (procesadas, total, filas_por_segundo) en el hilo principal
+        self.on_fin = on_fin  # Función (resultado) en el hilo principal
+        self.cancelado = threading.Event()
+        self.hilo = threading.Thread(target=self._ejecutar, name='ImportacionMasiva', daemon=True)
+        self.hilo.start()
+
+    def cancelar(self):
+        self.cancelado.set()
+
+    def _ejecutar(self):
+        inicio = time.perf_counter()
+        ultimo_aviso = 0
+        procesadas = 0
+        errores = []  # (fila, mensaje)
+        error = None
+        ahora = datetime.now()
+        fecha = ahora.strftime('%Y-%m-%d')
+        hora = ahora.strftime('%H:%M:%S')
+        conn = sqlite3.connect(self.db_path)
+        try:
+            filas = self._construir_filas(fecha, hora, errores)
+            for desde in range(0, len(filas), MASS_IMPORT_CHUNK_SIZE):
+                if self.cancelado.is_set():
+                    break
+                lote = filas[desde:desde + MASS_IMPORT_CHUNK_SIZE]
+                conn.executemany(SQL_INSERTAR_REVISION, lote)
+                procesadas += len(lote)
+                if time.perf_counter() - ultimo_aviso >= 1 / MASS_IMPORT_PROGRESS_HZ:
+                    ultimo_aviso = time.perf_counter()
+                    self._avisar_progreso(procesadas, ultimo_aviso - inicio)
+            if self.cancelado.is_set():
+                conn.rollback()
+            else:
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            error = str(e)
+        finally:
+            conn.close()
+        segundos = time.perf_counter() - inicio
+        resultado = {
+            'fecha': fecha,
+            'insertadas': 0 if error or self.cancelado.is_set() else procesadas,
+            'procesadas': procesadas,
+            'errores': errores,
+            'error': error,
+            'cancelado': self.cancelado.is_set(),
+            'segundos': segundos,
+            'filas_por_segundo': procesadas / segundos if segundos else 0,
+        }
+        if self.on_fin:
+            Clock.schedule_once(lambda dt: self.on_fin(resultado))
+
+    def _construir_filas(self, fecha, hora, errores):
+        """
+        Construye en una sola pasada las filas para SQL_INSERTAR_REVISION. Una celda vacía en una columna opcional
+        toma el valor del formulario (o el estado elegido); un valor no válido descarta la fila y se anota en errores.
+        """
+        f = self.formulario
+        columnas = self.importacion.columnas
+        i_tipo, i_cantidad, i_unidad, i_estado = (columnas.get(campo) for campo in IMPORT_OVERRIDE_COLUMNS)
+        estados = {normalizar_texto(estado): estado for estado in ESTADOS_REVISION}
+        tipos = {normalizar_texto(tipo): tipo for tipo in TIPOS_PRODUCTO + TIPOS_ESPECIALES}
+        vacias = [''] * (len(REV_DB_COLUMNS) - 10)
+        filas = []
+        for numero, row in zip(self.importacion.numeros, self.importacion.filas):
+            sku, titulo, _ = self.importacion.producto(row)
+            if sku is None:
+                errores.append((numero, 'SKU vacío'))
+                continue
+            tipo = valor_celda(row, i_tipo)
+            if tipo is None:
+                tipo = f['tipo']
+            else:
+                tipo = tipos.get(normalizar_texto(tipo))
+                if tipo is None:
+                    errores.append((numero, f'Tipo no válido: {row[i_tipo]}'))
+                    continue
+            cantidad = valor_celda(row, i_cantidad)
+            if cantidad is None:
+                cantidad = f['cantidad_neta']
+            elif isinstance(cantidad, float) and cantidad.is_integer():
+                cantidad = str(int(cantidad))
+            else:
+                cantidad = str(cantidad).strip()
+            unidad = valor_celda(row, i_unidad)
+            unidad = f['unidad'] if unidad is None else str(unidad).strip().upper()
+            if unidad and unidad not in UNIDADES:
+                errores.append((numero, f'UND/ML/GR no válido: {unidad}'))
+                continue
+            estado = valor_celda(row, i_estado)
+            if estado is not None:
+                estado = estados.get(normalizar_texto(estado))
+                if estado is None:
+                    errores.append((numero, f'Estado no válido: {row[i_estado]}'))
+                    continue
+            filas.append([uuid.uuid4().hex, fecha, hora, sku, titulo, tipo, f['tiene_pt'], f['tiene_es'], f['tiene_it'],
+                          cantidad, unidad, f['composicion_lote'] if tipo in TIPOS_CON_COMPOSICION else '',
+                          estado or self.estado] + vacias)
+        return filas
+
+    def _avisar_progreso(self, procesadas, segundos):
+        if self.on_progreso:
+            filas_por_segundo = procesadas / segundos if segundos else 0
+            Clock.schedule_once(lambda dt: self.on_progreso(procesadas, self.total, filas_por_segundo))
+
+class EscritorREV:
+    """
+    Escritura diferida (write-behind) de los archivos REV xlsx en un hilo en segundo plano.
+    Las revisiones nuevas quedan en la tabla revisiones con exportado = 0 (cola duradera: si la aplicación
+    se cierra antes de guardar, se vuelcan en el siguiente inicio). El hilo agrupa todas las pendientes y hace
+    un solo guardado por archivo cada REV_FLUSH_INTERVAL segundos o al llegar a REV_FLUSH_BATCH_SIZE revisiones.
+    Antes de sobrescribir un REV modificado fuera de la aplicación (main.py, a mano) incorpora sus filas nuevas
+    a la tabla; si no puede leerlo, no lo sobrescribe.
+    """
+    def __init__(self, db_path='db.db', intervalo=REV_FLUSH_INTERVAL, tamano_lote=REV_FLUSH_BATCH_SIZE, on_error=None, on_cambio=None):
+        self.db_path = db_path
+        self.intervalo = intervalo
+        self.tamano_lote = tamano_lote
+        self.on_error = on_error  # Función (mensaje) llamada en el hilo principal si falla un guardado
+        self.on_cambio = on_cambio  # Función (fechas) llamada en el hilo principal si se incorporaron filas ajenas
+        self.lock = threading.Lock()
+        self.evento = threading.Event()
+        self.pendientes = 0  # Profundidad de la cola (revisiones sin volcar al xlsx)
+        self.ultima_latencia = None  # Segundos que tardó el último volcado
+        self.activo = True
+        self.hilo = threading.Thread(target=self._bucle, name='EscritorREV', daemon=True)
+        self.hilo.start()
+
+    def encolar(self, cantidad):
+        with self.lock:
+            self.pendientes += cantidad
+            if self.pendientes >= self.tamano_lote:
+                self.evento.set()
+
+    def forzar(self):
+        """Solicita un volcado inmediato."""
+        self.evento.set()
+
+    def detener(self, timeout=30):
+        """Detiene el hilo después de un último volcado."""
+        self.activo = False
+        self.evento.set()
+        self.hilo.join(timeout)
+
+    def estado(self):
+        latencia = f'{self.ultima_latencia * 1000:.0f} ms' if self.ultima_latencia is not None else '-'
+        return f'Cola REV: {self.pendientes} | Último guardado: {latencia}'
+
+    def _bucle(self):
+        conn = sqlite3.connect(self.db_path)
+        while self.activo:
+            self.evento.wait(self.intervalo)
+            self.evento.clear()
+            self._volcar(conn)
+        self._volcar(conn)
+        conn.close()
+
+    def _volcar(self, conn):
+        try:
+            fechas = conn.execute('SELECT fecha, MAX(id) FROM revisiones WHERE exportado = 0 GROUP BY fecha').fetchall()
+        except sqlite3.OperationalError as e:
+            print(f"Error al leer las revisiones pendientes: {e}")
+            return
+        if not fechas:
+            return
+        inicio = time.perf_counter()
+        cambiadas = []
+        for fecha, ultimo_id in fechas:
+            archivo = ruta_rev(fecha)
+            try:
+                if not os.path.exists('REVs'):
+                    os.makedirs('REVs')
+                if archivo_rev_modificado(conn, archivo):
+                    incorporadas = self._incorporar_cambios(conn, archivo, fecha)
+                    if incorporadas is None:
+                        continue
+                    if incorporadas:
+                        cambiadas.append(fecha)
+                        ultimo_id = conn.execute('SELECT MAX(id) FROM revisiones WHERE fecha = ?', (fecha,)).fetchone()[0]
+                # El REV del día se regenera en streaming desde la tabla revisiones (memoria constante), en el orden
+                # de la hoja para las filas que ya estaban en ella y con los números de las filas incorporadas
+                columnas = ', '.join(f"coalesce(json_extract(valores, '$[{i}]'), {columna})" for i, columna in enumerate(REV_DB_COLUMNS))
+                exportar_consulta(archivo, REV_HEADERS, conn,
+                                  f'SELECT {columnas} FROM revisiones WHERE fecha = ? AND id <= ? ORDER BY posicion IS NULL, posicion, id',
+                                  (fecha, ultimo_id))
+                conn.execute('UPDATE revisiones SET exportado = 1 WHERE fecha = ? AND exportado = 0 AND id <= ?', (fecha, ultimo_id))
+                registrar_archivo_rev(conn, archivo, fecha)
+                conn.commit()
+            except PermissionError:
+                # Se reintentará en el siguiente volcado
+                self._notificar_error(f"No se puede guardar '{archivo}' (¿abierto en otro programa?). Se reintentará.")
+            except Exception as e:
+                self._notificar_error(f"Error al guardar el archivo de revisiones '{archivo}': {e}")
+        try:
+            pendientes = conn.execute('SELECT COUNT(*) FROM revisiones WHERE exportado = 0').fetchone()[0]
+        except sqlite3.OperationalError:
+            pendientes = self.pendientes
+        with self.lock:
+            self.pendientes = pendientes
+        self.ultima_latencia = time.perf_counter() - inicio
+        if cambiadas and self.on_cambio:
+            Clock.schedule_once(lambda dt: self.on_cambio(cambiadas))
+
+    def _incorporar_cambios(self, conn, archivo, fecha):
+        """
+        Incorpora las filas que se añadieron al REV xlsx fuera de la aplicación desde el último guardado.
+        Devuelve el número de filas incorporadas, o None (y avisa) si el archivo no se puede leer:
+        en ese caso no se sobrescribe.
+        """
+        try:
+            filas = filas_archivo_rev(archivo)
+            conn.execute('BEGIN IMMEDIATE')  # IndexadorREV puede estar incorporando el mismo archivo
+            try:
+                incorporadas = incorporar_filas_ajenas(conn, filas, fecha, os.path.basename(archivo))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            return incorporadas
+        except Exception as e:
+            self._notificar_error(f"'{archivo}' se modificó fuera de la aplicación y no se pudo leer ({e}); no se sobrescribe. Se reintentará.")
+            return None
+
+    def _notificar_error(self, mensaje):
+        print(mensaje)
+        if self.on_error:
+            Clock.schedule_once(lambda dt: self.on_error(mensaje))
+
+class MuestreadorRecursos:
+    """
+    Hilo en segundo plano que toma muestras de CPU, RAM, memoria (RSS) y handles abiertos del proceso
+    y estadísticas de db.db, y las guarda en un buffer circular. El título y el panel de diagnóstico
+    leen la última muestra sin bloquear el hilo de la interfaz.
+    """
+    def __init__(self, db_path='db.db', cache_kb=0, intervalo=RESOURCE_SAMPLE_INTERVAL, historial=RESOURCE_SAMPLE_HISTORY):
+        self.db_path = db_path
+        self.cache_kb = cache_kb  # Caché de páginas configurada en la conexión principal
+        self.intervalo = intervalo
+        self.muestras = deque(maxlen=historial)
+        self.proceso = psutil.Process()
+        self.evento = threading.Event()
+        self.hilo = threading.Thread(target=self._bucle, name='MuestreadorRecursos', daemon=True)
+        self.hilo.start()
+
+    def ultima(self):
+        return self.muestras[-1] if self.muestras else None
+
+    def detener(self):
+        self.evento.set()
+        self.hilo.join(2)
+
+    def _bucle(self):
+        conn = sqlite3.connect(self.db_path)
+        # Primera llamada de referencia: cpu_percent(None) mide desde la llamada anterior
+        psutil.cpu_percent(interval=None)
+        self.proceso.cpu_percent(interval=None)
+        while not self.evento.wait(self.intervalo):
+            try:
+                self.muestras.append(self._muestra(conn))
+            except Exception as e:
+                print(f"Error al tomar la muestra de recursos: {e}")
+        conn.close()
+
+    def _muestra(self, conn):
+        with self.proceso.oneshot():
+            rss = self.proceso.memory_info().rss
+            cpu_proceso = self.proceso.cpu_percent(interval=None)
+            handles = self.proceso.num_handles() if hasattr(self.proceso, 'num_handles') else self.proceso.num_fds()
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return {
+            'hora': time.time(),
+            'cpu': psutil.cpu_percent(interval=None),
+            'ram': psutil.virtual_memory().percent,
+            'cpu_proceso': cpu_proceso,
+            'rss': rss,
+            'handles': handles,
+            'db_bytes': page_size * page_count,
+            'db_paginas': page_count,
+            'db_paginas_libres': freelist,
+            'db_cache_kb': self.cache_kb,
+        }
+
+    def resumen(self):
+        """Texto con la última muestra y los máximos/medias del buffer, para el panel de diagnóstico."""
+        muestras = list(self.muestras)
+        if not muestras:
+            return 'Sin muestras todavía...'
+        ultima = muestras[-1]
+        media_cpu = sum(m['cpu_proceso'] for m in muestras) / len(muestras)
+        max_rss = max(m['rss'] for m in muestras)
+        return '\n'.join([
+            f"Muestras: {len(muestras)} (cada {self.intervalo} s)",
+            f"CPU sistema: {ultima['cpu']}% | RAM sistema: {ultima['ram']}%",
+            f"CPU proceso: {ultima['cpu_proceso']:.1f}% (media {media_cpu:.1f}%)",
+            f"Memoria proceso (RSS): {ultima['rss'] / 1048576:.1f} MB (máx. {max_rss / 1048576:.1f} MB)",
+            f"Handles abiertos: {ultima['handles']}",
+            f"db.db: {ultima['db_bytes'] / 1048576:.1f} MB | {ultima['db_paginas']} páginas ({ultima['db_paginas_libres']} libres)",
+            f"Caché de páginas SQLite (configurada): {ultima['db_cache_kb']} KB",
+        ])
+
+class ContadorRevisiones:
+    """
+    Conteo en memoria de las revisiones del día, por estado (título dinámico) y por código
+    EAN/SKU/ID y estado (comprobación "ya revisado hoy" con una sola búsqueda en un dict).
+    Se siembra con una consulta a la tabla revisiones (más las revisiones del diario aún no guardadas) al inicio
+    (primera lectura) y al cambiar de día; después solo se incrementa con cada revisión registrada, sin volver a leer nada.
+    """
+    def __init__(self, conn, pendientes=None):
+        self.conn = conn
+        self.pendientes = pendientes  # Función que devuelve los registros del diario aún no guardados en la tabla
+        self.fecha = None  # Día al que corresponden los conteos (None = sin sembrar)
+        self.conteos = {}  # estado -> número de revisiones
+        self.por_codigo = {}  # código -> {estado: número de revisiones}
+
+    def sembrar(self, fecha):
+        self.conteos = {}
+        self.por_codigo = {}
+        for codigo, estado, cantidad in self.conn.execute(
+                'SELECT ean_sku_id, estado, COUNT(*) FROM revisiones WHERE fecha = ? GROUP BY ean_sku_id, estado', (fecha,)):
+            self.conteos[estado] = self.conteos.get(estado, 0) + cantidad
+            por_estado = self.por_codigo.setdefault(str(codigo).strip(), {})
+            por_estado[estado] = por_estado.get(estado, 0) + cantidad
+        self.fecha = fecha
+        if self.pendientes:
+            indice_codigo = REV_DB_COLUMNS.index('ean_sku_id')
+            indice_estado = REV_DB_COLUMNS.index('estado')
+            self.sumar(fecha, ((registro['valores'][indice_codigo], registro['valores'][indice_estado])
+                               for registro in self.pendientes() if registro['fecha'] == fecha))
+
+    def invalidar(self):
+        """Fuerza una nueva siembra en la próxima lectura (p. ej. tras incorporar un REV xlsx antiguo)."""
+        self.fecha = None
+
+    def sumar(self, fecha, revisiones):
+        """Suma revisiones (pares código, estado) recién registradas (en el diario o en la tabla revisiones)."""
+        if fecha != self.fecha:
+            return  # Otro día o sin sembrar: la siembra ya incluirá estas revisiones
+        for codigo, estado in revisiones:
+            self.conteos[estado] = self.conteos.get(estado, 0) + 1
+            por_estado = self.por_codigo.setdefault(str(codigo).strip(), {})
+            por_estado[estado] = por_estado.get(estado, 0) + 1
+
+    def comprobar_dia(self):
+        fecha = datetime.now().strftime('%Y-%m-%d')
+        if fecha != self.fecha:
+            self.sembrar(fecha)
+
+    def totales(self):
+        """Devuelve (REV, RYT) del día actual; REV incluye las revisiones con traducción."""
+        self.comprobar_dia()
+        ryt_count = self.conteos.get("Revisado y Traducido", 0)
+        return self.conteos.get("Solo Revisión", 0) + ryt_count, ryt_count
+
+    def revisiones_de(self, codigo):
+        """Devuelve {estado: número de revisiones} del código en el día actual (vacío si no se revisó)."""
+        self.comprobar_dia()
+        return self.por_codigo.get(str(codigo).strip(), {})
+
 # Función para actualizar el título de la ventana dinámicamente
 def update_window_title(dt=None):
     """Actualiza el título de la ventana con el conteo dinámico y el uso de recursos."""
     if not ENABLE_DYNAMIC_TITLE:
         return  # Salir si el título dinámico está desactivado
 
-    fecha = datetime.now().strftime('%d-%m-%Y')
-    archivo = f'REVs/REV-{fecha}.xlsx'
     rev_count = 0
     ryt_count = 0
 
-    if os.path.exists(archivo):
-        wb = load_workbook(archivo, data_only=True)  # Asegurarse de cargar valores calculados
-        ws = wb.active
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            if row:  # Verificar que la fila no esté vacía
-                estado = row[9]  # Columna "Estado"
-                if estado == "Solo Revisión":
-                    rev_count += 1
-                elif estado == "Revisado y Traducido":
-                    rev_count += 1
-                    ryt_count += 1
-
-    # Obtener el uso de CPU y RAM
-    cpu_usage = psutil.cpu_percent(interval=0.1)
-    ram_usage = psutil.virtual_memory().percent
+    app = App.get_running_app()
+    try:
+        # Contadores en memoria: solo consultan la base de datos al inicio y al cambiar de día
+        rev_count, ryt_count = app.contador_rev.totales()
+    except sqlite3.OperationalError as e:
+        print(f"Error al contar las revisiones: {e}")
+
+    # Última muestra de CPU y RAM tomada por MuestreadorRecursos (sin bloquear)
+    muestra = app.muestreador.ultima()
+    cpu_usage = muestra['cpu'] if muestra else '-'
+    ram_usage = muestra['ram'] if muestra else '-'
 
     # Actualizar el título de la ventana
     Window.set_title(f'Contador de Revisiones V2.1 (DEV) REV: {rev_count} / RYT: {ryt_count} (CPU: {cpu_usage}% / RAM: {ram_usage}%)')
@@ -117,9 +1367,11 @@ class CustomSwitch(Switch):
 class ContadorApp(App):
     # --- Configuración de paginación de resultados ---
     RESULTS_BLOCK_SIZE = 50  # Cambia este valor para modificar el tamaño del bloque de resultados por página
+    HISTORIAL_PAGE_SIZE = 5  # Revisiones por página en el Historial
 
     def build(self):
         self.title = 'Contador de Revisiones V2.1 (DEV)'
+        self.detenida = False  # on_stop ya ejecutado
         self.screen_manager = ScreenManager()
 
         self.main_screen = Screen(name='main')
@@ -198,7 +1450,7 @@ class ContadorApp(App):
         self.tipo_combobox.bind(on_release=self.open_dropdown)
         
         # Lista de tipos
-        self.tipos = ['ACCESSORIES', 'administración', 'AFEITAR AFTER PRESHAVE', 'AFEITAR CREMA ESPUMA BROCHA', 'AFEITAR HOJA MAQUINA BROCHA', 'ALIMENTOS ENVASADOS', 'ALIMENTOS MASCOTAS', 'ALMACEN VARIOS', 'AMBIENTADORES', 'ANEXOS', 'Automatico desde Articulo', 'BAÑO DESODORANTE', 'BAÑO GEL', 'BAÑO JABON', 'BAÑO LECHE BODY L. ACEITE', 'BAÑO TALCO', 'BAÑO-VARIOS', 'BEBIDAS ENVASADAS', 'BEELINE', 'BISUTERIA', 'CABELLO ACONDIC. SUAVIZANTE', 'CABELLO CHAMPU', 'CABELLO FIJADOR BRILLANTINA', 'CABELLO LACA', 'CABELLO TINTES', 'CABELLO TONICO LOCION', 'CHRISTMAS', 'DENTIFRICO', 'DEPILATORIO', 'DESCUENTO PROMO', 'DUPLOS', 'ESTUCHES COLORIDO FLORES', 'ESTUCHES TRATAMIENTO', 'GIFT WRAPPING', 'GRANELES', 'HIGIENE CELULOSA', 'HIGIENE MASCOTAS', 'HOBBY', 'HOME INTERIOR', 'JUEGOS EROTICOS', 'LOTES', 'MAQUILLAJE CUERPO', 'MAQUILLAJE LABIOS', 'MAQUILLAJE MANOS', 'MAQUILLAJE OJOS', 'MAQUILLAJE ROSTRO', 'MAQUILLAJE SURTIDO', 'MATERIAL CONSUMIBLE', 'MATERIAL PLV', 'MATERIAL PLV ESPECIFICO', 'MINIATURAS', 'MUY MUCHO', 'P01', 'PARTY ARTICLES', 'PELUCHES JUGUETES', 'PELUQUERIA FRANCK PROVOST', 'PERF. ESTUCHES HOMBRE', 'PERF. ESTUCHES MUJER', 'PERF.ALC.FEMENINA', 'PERF.ALC.FEMENINA ALMACEN', 'PERF.ALC.INFANTIL', 'PERF.ALC.INFANTIL ALMACEN', 'PERF.ALC.MASCULINA', 'PERF.ALC.MASCULINA ALMACEN', 'PROMOCIONAL FEMENINO ALMACEN', 'PROMOCIONAL MASCULINO ALMACEN', 'PROMOCIONALES FEMENINOS', 'PROMOCIONALES MASCULINOS', 'PRUEBAS EXCEL', 'SEASON', 'STATIONERY', 'SUSCRIPCIONES', 'TARJETAS REGALO DIGITALES', 'TARJETAS REGALO FISICAS', 'TEENS', 'TEXTIL', 'TOYS', 'TRAT.FEMENINO', 'TRAT.MASCULINO', 'TRAT.SOLAR', 'TRATAMIENTO CUERPO MANOS', 'VALE', 'VARIOS', 'VARIOS SIN CODIFICAR', 'VARIOUS ITEMS']
+        self.tipos = TIPOS_PRODUCTO
         for tipo in self.tipos:
             btn = Button(text=tipo, size_hint_y=None, height=44)
             btn.bind(on_release=lambda btn: self.dropdown.select(btn.text))
@@ -227,6 +1479,9 @@ class ContadorApp(App):
         self.marca_titulo = TextInput(hint_text='MARCA/TITULO', multiline=False, size_hint=(1, 0.1))
         self.marca_titulo.bind(on_text_validate=self.on_marca_titulo_enter)
         self.marca_titulo.bind(on_text_validate=self.focus_next)
+        self.marca_titulo.bind(text=self.on_marca_titulo_text)
+        self.suggestions_dropdown = DropDown()
+        self.suggestion_event = None
         self.root.add_widget(self.marca_titulo)
         
         # Checkboxes
@@ -320,6 +1575,19 @@ class ContadorApp(App):
         self.lock_mode = False  # Estado inicial del modo bloqueo
         self.locked_values = {}  # Diccionario para almacenar los valores bloqueados
         
+        self.init_catalog_caches()
+        if ENABLE_SEARCH_AS_YOU_TYPE:
+            self.buscador_sugerencias = BuscadorSugerencias(self.search_titles_in_db, self.show_suggestions)
+        self.escritor_rev = EscritorREV(on_error=lambda mensaje: setattr(self.status_bar, 'text', f'Estado: {mensaje}'),
+                                        on_cambio=self.on_rev_index_changed)
+        self.escritor_rev.encolar(self.cursor.execute('SELECT COUNT(*) FROM revisiones WHERE exportado = 0').fetchone()[0])
+        Clock.schedule_interval(self.retry_revision_journal, REV_JOURNAL_REPLAY_INTERVAL)
+        cache_size = self.cursor.execute('PRAGMA cache_size').fetchone()[0]
+        # cache_size negativo = KiB; positivo = páginas
+        cache_kb = -cache_size if cache_size < 0 else cache_size * self.cursor.execute('PRAGMA page_size').fetchone()[0] // 1024
+        self.muestreador = MuestreadorRecursos(cache_kb=cache_kb)
+        self.indexador_rev = IndexadorREV(on_cambio=self.on_rev_index_changed)
+        Window.bind(on_key_down=self.on_diagnostics_key)
         Clock.schedule_interval(self.check_focus, 0.1)  # Verificar el foco cada 0.1 segundos
         Clock.schedule_once(lambda dt: self.update_all_fonts(), 0)
         return self.root
@@ -327,6 +1595,8 @@ class ContadorApp(App):
     def init_db(self):
         self.conn = sqlite3.connect('db.db')
         self.cursor = self.conn.cursor()
+        if ENABLE_WAL:
+            self.cursor.execute('PRAGMA journal_mode=WAL')
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS productos (
                 sku TEXT PRIMARY KEY,
@@ -334,7 +1604,370 @@ class ContadorApp(App):
                 eans TEXT
             )
         ''')
+        # Tabla índice EAN -> SKU: una fila por cada EAN de cada producto
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS product_eans (
+                ean TEXT NOT NULL,
+                sku TEXT NOT NULL,
+                PRIMARY KEY (ean, sku)
+            ) WITHOUT ROWID
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_eans_sku ON product_eans (sku)')
+        self.create_product_eans_triggers()
+        # Contador de cambios del catálogo: lo incrementan los triggers de productos (de cualquier conexión o proceso)
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS catalogo_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+        ''')
+        self.cursor.execute('INSERT OR IGNORE INTO catalogo_version (id, version) VALUES (1, 0)')
+        for evento in ('INSERT', 'UPDATE', 'DELETE'):
+            self.cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS productos_version_{evento.lower()} AFTER {evento} ON productos BEGIN
+                    UPDATE catalogo_version SET version = version + 1 WHERE id = 1;
+                END
+            ''')
+        # Revisiones registradas: fuente de verdad de los archivos REVs/REV-<fecha>.xlsx
+        self.cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS revisiones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fecha TEXT NOT NULL,
+                hora TEXT NOT NULL,
+                {', '.join(f'{columna} TEXT' for columna in REV_DB_COLUMNS)}
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_revisiones_fecha ON revisiones (fecha, id)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_revisiones_sku ON revisiones (ean_sku_id, fecha)')
+        # Historial filtrado por estado o tipo, del más reciente al más antiguo
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_revisiones_estado ON revisiones (estado, fecha, id)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_revisiones_tipo ON revisiones (tipo, fecha, id)')
+        self.migrate_db()
+        self.init_fts()
         self.conn.commit()
+        self.rev_dates_checked = set()  # Fechas cuyo REV xlsx previo ya se incorporó a la tabla revisiones
+        self.diario_rev = DiarioRevisiones()
+        # Revisiones del día: conteos REV/RYT y por código (incluidas las del diario aún no guardadas)
+        self.contador_rev = ContadorRevisiones(self.conn, pendientes=self.diario_rev.registros_pendientes)
+        self.adopt_legacy_rev_workbook(datetime.now().strftime('%Y-%m-%d'))
+        try:
+            # Revisiones que quedaron en el diario en la sesión anterior (cierre inesperado o base de datos bloqueada)
+            self.replay_revision_journal()
+            if not self.diario_rev.pendientes():
+                self.diario_rev.vaciar()
+        except sqlite3.OperationalError as e:
+            print(f"No se pudo reproducir el diario de revisiones: {e}")
+
+    def create_product_eans_triggers(self):
+        """Triggers para mantener product_eans sincronizada con productos."""
+        self.cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS productos_eans_insert AFTER INSERT ON productos BEGIN
+                INSERT OR IGNORE INTO product_eans (ean, sku)
+                SELECT {sql_ean('value')}, NEW.sku FROM json_each({sql_lista_eans('NEW.eans')}) WHERE {sql_ean('value')} <> '';
+            END
+        ''')
+        self.cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS productos_eans_delete AFTER DELETE ON productos BEGIN
+                DELETE FROM product_eans WHERE sku = OLD.sku;
+            END
+        ''')
+        self.cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS productos_eans_update AFTER UPDATE OF sku, eans ON productos BEGIN
+                DELETE FROM product_eans WHERE sku = OLD.sku;
+                INSERT OR IGNORE INTO product_eans (ean, sku)
+                SELECT {sql_ean('value')}, NEW.sku FROM json_each({sql_lista_eans('NEW.eans')}) WHERE {sql_ean('value')} <> '';
+            END
+        ''')
+
+    def init_fts(self):
+        """
+        Crea los índices FTS5 sobre productos.titulo y los triggers que los mantienen actualizados:
+        - productos_fts: palabras completas/prefijos, sin distinguir mayúsculas ni acentos.
+        - productos_trigram: trigramas, para buscar fragmentos en cualquier parte del título.
+        Si FTS5 no está disponible se usará la búsqueda LIKE.
+        """
+        self.fts_enabled = self.create_fts_index('productos_fts', ['unicode61 remove_diacritics 2', 'unicode61 remove_diacritics 1'])
+        self.trigram_enabled = self.create_fts_index('productos_trigram', ['trigram remove_diacritics 1', 'trigram case_sensitive 0'])
+
+    def create_fts_index(self, tabla, tokenizadores):
+        """
+        Crea (si no existe) una tabla FTS5 de contenido externo sobre productos.titulo con el primer
+        tokenizador soportado por esta versión de SQLite, y sus triggers de sincronización.
+        Devuelve True si el índice está disponible.
+        """
+        existia = self.cursor.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (tabla,)).fetchone()
+        try:
+            if not existia:
+                for i, tokenizador in enumerate(tokenizadores):
+                    try:
+                        self.cursor.execute(f'''
+                            CREATE VIRTUAL TABLE {tabla} USING fts5(
+                                titulo, content='productos', content_rowid='rowid',
+                                tokenize='{tokenizador}'
+                            )
+                        ''')
+                        break
+                    except sqlite3.OperationalError:
+                        # Versiones antiguas de SQLite sin este tokenizador u opción
+                        if i == len(tokenizadores) - 1:
+                            raise
+                self.cursor.execute(f"INSERT INTO {tabla} ({tabla}) VALUES ('rebuild')")
+            self.cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {tabla}_insert AFTER INSERT ON productos BEGIN
+                    INSERT INTO {tabla} (rowid, titulo) VALUES (NEW.rowid, NEW.titulo);
+                END
+            ''')
+            self.cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {tabla}_delete AFTER DELETE ON productos BEGIN
+                    INSERT INTO {tabla} ({tabla}, rowid, titulo) VALUES ('delete', OLD.rowid, OLD.titulo);
+                END
+            ''')
+            self.cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {tabla}_update AFTER UPDATE OF titulo ON productos BEGIN
+                    INSERT INTO {tabla} ({tabla}, rowid, titulo) VALUES ('delete', OLD.rowid, OLD.titulo);
+                    INSERT INTO {tabla} (rowid, titulo) VALUES (NEW.rowid, NEW.titulo);
+                END
+            ''')
+            return True
+        except sqlite3.OperationalError as e:
+            print(f"Índice {tabla} no disponible, se usará la búsqueda LIKE: {e}")
+            return False
+
+    def init_catalog_caches(self):
+        """
+        Construye en segundo plano el índice EAN/SKU en memoria y el filtro Bloom si están habilitados,
+        y programa la detección de cambios en el catálogo. Mientras no están listos, las búsquedas van a la DB.
+        """
+        self.indice_ean = None
+        self.filtro_bloom = None
+        self.bloom_consultas_evitadas = 0  # Consultas a la DB evitadas por el filtro Bloom
+        self.catalog_cache_estado = 'Cachés del catálogo deshabilitadas'
+        self.catalog_version = None
+        self.catalog_rebuilding = False  # Hay una reconstrucción en curso (hasta que se sustituyen las cachés)
+        self.catalog_cambios_pendientes = []  # Productos añadidos mientras se reconstruyen las cachés
+        self.catalog_versiones_pendientes = []  # (versión antes, versión después) de esas transacciones propias
+        if not (ENABLE_MEMORY_INDEX or ENABLE_BLOOM_FILTER):
+            return
+        self.rebuild_catalog_caches()
+        Clock.schedule_interval(self.check_catalog_version, CATALOG_CHECK_INTERVAL)
+
+    def rebuild_catalog_caches(self):
+        """Reconstruye las cachés del catálogo en un hilo; las actuales se siguen usando hasta que terminan."""
+        if self.catalog_rebuilding:
+            return
+        self.catalog_rebuilding = True
+        self.catalog_cambios_pendientes = []
+        self.catalog_versiones_pendientes = []
+        self.catalog_cache_estado = 'Construyendo cachés del catálogo...'
+
+        def construir():
+            try:
+                resultado = construir_caches_catalogo()
+            except sqlite3.Error as e:
+                print(f"Error al construir las cachés del catálogo: {e}")
+                resultado = None
+            Clock.schedule_once(lambda dt: self.on_catalog_caches_built(resultado))
+
+        threading.Thread(target=construir, name='CachesCatalogo', daemon=True).start()
+
+    def on_catalog_caches_built(self, resultado):
+        """Sustituye las cachés por las recién construidas y les aplica los productos añadidos entretanto."""
+        self.catalog_rebuilding = False
+        pendientes, self.catalog_cambios_pendientes = self.catalog_cambios_pendientes, []
+        versiones, self.catalog_versiones_pendientes = self.catalog_versiones_pendientes, []
+        if resultado is None:
+            self.catalog_cache_estado = 'Error al construir las cachés del catálogo'
+            return
+        self.catalog_version, self.indice_ean, self.filtro_bloom = resultado
+        if pendientes:
+            self.update_catalog_caches(pendientes, versiones)
+        estado = []
+        if self.indice_ean is not None:
+            memoria_mb = self.indice_ean.memoria / (1024 * 1024)
+            estado.append(f'Índice EAN en memoria: {len(self.indice_ean.titulos)} productos en {self.indice_ean.build_time * 1000:.0f} ms ({memoria_mb:.1f} MB)')
+        if self.filtro_bloom is not None:
+            estado.append(f'Filtro Bloom: {len(self.filtro_bloom.bits) // 1024} KB, consultas evitadas: {self.bloom_consultas_evitadas}')
+        self.catalog_cache_estado = ' | '.join(estado)
+
+    def update_catalog_caches(self, productos, versiones=()):
+        """
+        Actualiza en el sitio el índice en memoria y el filtro Bloom con productos (sku, titulo, eans) recién añadidos
+        (ya confirmados). `versiones` son los pares (versión antes, versión después) de cada transacción propia:
+        si encadenan con la versión de las cachés, solo hubo cambios propios y no hace falta reconstruir.
+        """
+        if self.catalog_rebuilding:
+            # La reconstrucción en curso puede haber leído el catálogo antes de estos cambios
+            self.catalog_cambios_pendientes.extend(productos)
+            self.catalog_versiones_pendientes.extend(versiones)
+        elif self.catalog_version is not None and not self.avanzar_version_catalogo(versiones):
+            # Otro proceso cambió el catálogo antes o entre nuestras transacciones: las cachés no tienen esos cambios
+            self.rebuild_catalog_caches()
+        if len(productos) > CATALOG_UPSERT_CHUNK_SIZE:
+            # Altas masivas: reconstruir una sola vez es más rápido que añadir uno a uno (y saturar el filtro Bloom)
+            self.rebuild_catalog_caches()
+            return
+        for sku, titulo, eans in productos:
+            if self.indice_ean is not None:
+                self.indice_ean.agregar_producto(sku, titulo, eans)
+            if self.filtro_bloom is not None:
+                self.filtro_bloom.agregar(sku)
+                for ean in dividir_eans(eans):
+                    self.filtro_bloom.agregar(ean)
+        if self.filtro_bloom is not None and self.filtro_bloom.saturado:
+            self.rebuild_catalog_caches()
+
+    def avanzar_version_catalogo(self, versiones):
+        """
+        Avanza self.catalog_version por las transacciones propias (antes, después), en orden. Las que ya incluía
+        la última reconstrucción se saltan. Devuelve False si alguna no empieza donde acabó la anterior.
+        """
+        for antes, despues in versiones:
+            if despues <= self.catalog_version:
+                continue
+            if antes != self.catalog_version:
+                return False
+            self.catalog_version = despues
+        return True
+
+    def upsert_products(self, productos, tamano_bloque=CATALOG_UPSERT_CHUNK_SIZE):
+        """
+        Registra productos (sku, titulo, eans) en bloque con INSERT ... ON CONFLICT(sku) DO UPDATE:
+        si el SKU ya existe, se añaden en SQL los EANs nuevos a su lista (sin duplicados) y se conserva su título.
+        Confirma cada `tamano_bloque` productos y actualiza las cachés del catálogo.
+        Devuelve un informe por fila: lista de (sku, resultado) con resultado 'insertado', 'actualizado',
+        'sin cambios' o 'error: ...', en el mismo orden que `productos`.
+        """
+        sql = f'''
+            INSERT INTO productos (sku, titulo, eans) VALUES (?, ?, ?)
+            ON CONFLICT(sku) DO UPDATE SET
+                titulo = CASE WHEN trim(coalesce(productos.titulo, '')) = '' THEN excluded.titulo ELSE productos.titulo END,
+                eans = coalesce((
+                    SELECT group_concat(ean, ',') FROM (
+                        SELECT {sql_ean('value')} AS ean, MIN(orden) AS orden FROM (
+                            SELECT value, key AS orden FROM json_each({sql_lista_eans('productos.eans')})
+                            UNION ALL
+                            SELECT value, 1000000 + key FROM json_each({sql_lista_eans('excluded.eans')})
+                        )
+                        WHERE {sql_ean('value')} <> '' GROUP BY {sql_ean('value')} ORDER BY orden
+                    )
+                ), '')
+        '''
+        informe = []
+        cambiados = {}
+        versiones = []  # (versión del catálogo antes, después) de cada bloque confirmado
+        productos = iter(productos)
+        while True:
+            bloque = list(islice(productos, tamano_bloque))
+            if not bloque:
+                break
+            normalizados = [('' if sku is None else str(sku).strip(), titulo, '' if eans is None else str(eans).strip())
+                            for sku, titulo, eans in bloque]
+            filas = [fila for fila in normalizados if fila[0]]
+            # Estado previo de los SKUs del bloque para saber qué se insertó y qué se actualizó
+            existentes = {sku: (titulo, eans) for sku, titulo, eans in self.cursor.execute(
+                'SELECT sku, titulo, eans FROM productos WHERE sku IN (SELECT value FROM json_each(?))',
+                (json.dumps([sku for sku, _, _ in filas]),))}
+            resultados = []
+            cambiados_bloque = {}
+            for sku, titulo, eans in normalizados:
+                if not sku:
+                    resultados.append((sku, 'error: SKU vacío'))
+                    continue
+                previo = existentes.get(sku)
+                if previo is None:
+                    final = (titulo, eans)
+                    resultados.append((sku, 'insertado'))
+                else:
+                    titulo_previo, eans_previos = previo
+                    lista = dividir_eans(eans_previos)
+                    nuevos = [ean for ean in dict.fromkeys(dividir_eans(eans)) if ean not in lista]
+                    final = (titulo_previo if str(titulo_previo or '').strip() else titulo, ','.join(lista + nuevos))
+                    resultados.append((sku, 'actualizado' if final != previo else 'sin cambios'))
+                existentes[sku] = final
+                cambiados_bloque[sku] = final
+            try:
+                # Versión leída dentro de la transacción: nadie más puede cambiar productos entre las dos lecturas
+                if not self.conn.in_transaction:
+                    self.cursor.execute('BEGIN IMMEDIATE')
+                antes = leer_version_catalogo(self.cursor)
+                self.cursor.executemany(sql, filas)
+                despues = leer_version_catalogo(self.cursor)
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                informe.extend((sku, resultado if resultado.startswith('error') else f'error: {e}') for sku, resultado in resultados)
+                continue
+            versiones.append((antes, despues))
+            informe.extend(resultados)
+            cambiados.update(cambiados_bloque)
+        self.update_catalog_caches([(sku, titulo, eans) for sku, (titulo, eans) in cambiados.items()], versiones)
+        return informe
+
+    def check_catalog_version(self, dt):
+        """Reconstruye las cachés si otra conexión o proceso modificó productos (tabla catalogo_version)."""
+        if self.catalog_rebuilding:
+            return
+        try:
+            if leer_version_catalogo(self.cursor) != self.catalog_version:
+                self.rebuild_catalog_caches()
+        except sqlite3.OperationalError as e:
+            print(f"Error al comprobar cambios en la base de datos: {e}")
+
+    def migrate_db(self):
+        """
+        Aplica las migraciones pendientes de la base de datos según PRAGMA user_version.
+        Cada migración se ejecuta una sola vez.
+        """
+        version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            # Explotar la columna "eans" existente en la tabla product_eans
+            self.cursor.execute(f'''
+                INSERT OR IGNORE INTO product_eans (ean, sku)
+                SELECT {sql_ean('value')}, productos.sku FROM productos, json_each({sql_lista_eans('productos.eans')})
+                WHERE {sql_ean('value')} <> ''
+            ''')
+            self.cursor.execute('PRAGMA user_version = 1')
+        if version < 2:
+            # Cola de escritura diferida: revisiones aún no volcadas al REV xlsx (las existentes ya se exportaron)
+            self.cursor.execute('ALTER TABLE revisiones ADD COLUMN exportado INTEGER NOT NULL DEFAULT 1')
+            self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_revisiones_pendientes ON revisiones (id) WHERE exportado = 0')
+            self.cursor.execute('PRAGMA user_version = 2')
+        if version < 3:
+            # Identificador único por revisión para reproducir el diario sin duplicados
+            self.cursor.execute('ALTER TABLE revisiones ADD COLUMN uid TEXT')
+            self.cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_revisiones_uid ON revisiones (uid)')
+            self.cursor.execute('PRAGMA user_version = 3')
+        if version < 4:
+            # Archivo REV xlsx del que se incorporó cada revisión (NULL = registrada en la aplicación)
+            self.cursor.execute('ALTER TABLE revisiones ADD COLUMN archivo TEXT')
+            self.cursor.execute('''UPDATE revisiones SET archivo = 'REV-' || substr(fecha, 9, 2) || '-' || substr(fecha, 6, 2) || '-' || substr(fecha, 1, 4) || '.xlsx'
+                                   WHERE hora = '' AND uid IS NULL''')
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS archivos_rev (
+                    archivo TEXT PRIMARY KEY,
+                    fecha TEXT NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    tamano INTEGER NOT NULL
+                )
+            ''')
+            self.cursor.execute('PRAGMA user_version = 4')
+        if version < 5:
+            # Los triggers anteriores descartaban todos los EANs de un producto si su lista tenía caracteres de control
+            self.cursor.execute('DROP TRIGGER IF EXISTS productos_eans_insert')
+            self.cursor.execute('DROP TRIGGER IF EXISTS productos_eans_update')
+            self.create_product_eans_triggers()
+            self.cursor.execute('DELETE FROM product_eans')
+            self.cursor.execute(f'''
+                INSERT OR IGNORE INTO product_eans (ean, sku)
+                SELECT {sql_ean('value')}, productos.sku FROM productos, json_each({sql_lista_eans('productos.eans')})
+                WHERE {sql_ean('value')} <> ''
+            ''')
+            self.cursor.execute('PRAGMA user_version = 5')
+        if version < 6:
+            # Filas incorporadas de un REV xlsx: posición en la hoja (orden al regenerarlo) y sus valores numéricos (JSON)
+            self.cursor.execute('ALTER TABLE revisiones ADD COLUMN posicion INTEGER')
+            self.cursor.execute('ALTER TABLE revisiones ADD COLUMN valores TEXT')
+            self.cursor.execute('PRAGMA user_version = 6')
 
     def on_window_resize(self, instance, width, height):
         if (width, height) == (580, 391):
@@ -445,6 +2078,13 @@ class ContadorApp(App):
         Permite valores como NO-EAN y NO-DESC.
         Devuelve una lista de tuplas (sku, titulo) de los productos encontrados.
         """
+        if self.indice_ean is not None:
+            return self.indice_ean.buscar(ean)
+        if self.filtro_bloom is not None and ean not in self.filtro_bloom:
+            # Fallo seguro: el código no está en el catálogo, no hace falta consultar la DB
+            self.bloom_consultas_evitadas += 1
+            self.status_bar.text = f'Estado: Código no registrado (consultas evitadas por filtro Bloom: {self.bloom_consultas_evitadas})'
+            return []
         try:
             # Buscar por SKU exacto (clave única)
             self.cursor.execute('SELECT sku, titulo FROM productos WHERE sku = ?', (ean,))
@@ -452,15 +2092,13 @@ class ContadorApp(App):
             if row:
                 return [row]
 
-            # Buscar por EAN exacto en la lista de EANs (separados por coma)
-            self.cursor.execute('SELECT sku, titulo, eans FROM productos')
-            matches = []
-            for sku, titulo, eans in self.cursor.fetchall():
-                if eans:
-                    ean_list = [x.strip() for x in eans.split(',')]
-                    if ean in ean_list:
-                        matches.append((sku, titulo))
-            return matches
+            # Buscar por EAN exacto en la tabla índice product_eans
+            self.cursor.execute('''
+                SELECT productos.sku, productos.titulo FROM product_eans
+                JOIN productos ON productos.sku = product_eans.sku
+                WHERE product_eans.ean = ?
+            ''', (ean,))
+            return self.cursor.fetchall()
         except sqlite3.OperationalError as e:
             if "database is locked" in str(e):
                 msg = "La base de datos está en uso por otro proceso. Por favor, cierre cualquier programa que esté usando 'db.db' y vuelva a intentarlo."
@@ -470,19 +2108,78 @@ class ContadorApp(App):
             else:
                 raise
 
+    def resolve_many(self, codes, by_ean=True):
+        """
+        Resuelve muchos SKUs/EANs en una sola pasada usando una tabla temporal y joins.
+        Con by_ean=False solo se buscan coincidencias exactas de SKU.
+        Devuelve un diccionario con tres grupos:
+        - 'found': {codigo: (sku, titulo, eans)} para los códigos con un único producto.
+        - 'missing': [codigo, ...] para los códigos sin producto.
+        - 'ambiguous': {codigo: [(sku, titulo, eans), ...]} para los EANs compartidos por varios productos.
+        """
+        codigos = list(dict.fromkeys(str(code).strip() for code in codes if code is not None and str(code).strip()))
+        coincidencias = {}
+        consultar = codigos
+        if self.indice_ean is not None:
+            # Los códigos que no están en el índice en memoria no existen en el catálogo
+            consultar = [codigo for codigo in codigos
+                         if codigo in self.indice_ean.titulos or (by_ean and codigo in self.indice_ean.por_ean)]
+        elif self.filtro_bloom is not None:
+            # Los fallos seguros del filtro Bloom no necesitan pasar por la DB
+            consultar = [codigo for codigo in codigos if codigo in self.filtro_bloom]
+            self.bloom_consultas_evitadas += len(codigos) - len(consultar)
+        self.cursor.execute('CREATE TEMP TABLE IF NOT EXISTS codigos_consulta (codigo TEXT PRIMARY KEY)')
+        try:
+            self.cursor.executemany('INSERT OR IGNORE INTO codigos_consulta (codigo) VALUES (?)', ((codigo,) for codigo in consultar))
+            # El SKU exacto tiene prioridad sobre el EAN (igual que search_product_in_db)
+            self.cursor.execute('''
+                SELECT codigos_consulta.codigo, productos.sku, productos.titulo, productos.eans
+                FROM codigos_consulta JOIN productos ON productos.sku = codigos_consulta.codigo
+            ''')
+            for codigo, sku, titulo, eans in self.cursor.fetchall():
+                coincidencias[codigo] = [(sku, titulo, eans)]
+            if by_ean:
+                self.cursor.execute('''
+                    SELECT codigos_consulta.codigo, productos.sku, productos.titulo, productos.eans
+                    FROM codigos_consulta
+                    JOIN product_eans ON product_eans.ean = codigos_consulta.codigo
+                    JOIN productos ON productos.sku = product_eans.sku
+                    WHERE NOT EXISTS (SELECT 1 FROM productos WHERE productos.sku = codigos_consulta.codigo)
+                ''')
+                for codigo, sku, titulo, eans in self.cursor.fetchall():
+                    coincidencias.setdefault(codigo, []).append((sku, titulo, eans))
+        finally:
+            self.cursor.execute('DELETE FROM codigos_consulta')
+            self.conn.commit()
+
+        resultado = {'found': {}, 'missing': [], 'ambiguous': {}}
+        for codigo in codigos:
+            productos = coincidencias.get(codigo)
+            if not productos:
+                resultado['missing'].append(codigo)
+            elif len(productos) == 1:
+                resultado['found'][codigo] = productos[0]
+            else:
+                resultado['ambiguous'][codigo] = productos
+        return resultado
+
     def check_revision_status(self, sku):
-        fecha = datetime.now().strftime('%d-%m-%Y')
-        archivo = f'REVs/REV-{fecha}.xlsx'
-        if os.path.exists(archivo):
-            try:
-                wb = load_workbook(archivo)
-                ws = wb.active
-                for row in ws.iter_rows(min_row=2, values_only=True):
-                    if row[0] == sku:
-                        return 'YA REVISADO/TRADUCIDO'
-            except Exception as e:
-                print(f"Error al leer el archivo de revisiones: {e}")
-        return 'SIN REVISION'
+        try:
+            por_estado = self.contador_rev.revisiones_de(sku)
+            anterior = self.last_revision_before_today(sku)
+        except sqlite3.OperationalError as e:
+            print(f"Error al leer las revisiones: {e}")
+            return 'SIN REVISION'
+        if por_estado:
+            veces = sum(por_estado.values())
+            detalle = ', '.join(f'{estado or "Sin estado"}: {cantidad}' for estado, cantidad in por_estado.items())
+            estado_revision = f'YA REVISADO/TRADUCIDO ({veces} {"vez" if veces == 1 else "veces"} hoy - {detalle})'
+        else:
+            estado_revision = 'SIN REVISION'
+        if anterior:
+            fecha, estado = anterior
+            estado_revision += f"\nÚltima revisión anterior: {datetime.strptime(fecha, '%Y-%m-%d').strftime('%d-%m-%Y')} ({estado or 'Sin estado'})"
+        return estado_revision
 
     def show_loading_popup(self, message):
         content = BoxLayout(orientation='vertical', padding=10)
@@ -559,22 +2256,25 @@ class ContadorApp(App):
         if sku and title and eans:
             self.show_loading_popup('Añadiendo a la base de datos...')
             self.root.do_layout()
-            try:
-                self.cursor.execute('INSERT INTO productos (sku, titulo, eans) VALUES (?, ?, ?)', (sku, title, eans))
-                self.conn.commit()
-                self.loading_popup.dismiss()
-                if hasattr(self, 'add_to_db_popup'):  # Verificar si el popup existe
-                    self.add_to_db_popup.dismiss()
-                self.ean_sku_id.text = sku
-                self.marca_titulo.text = title
-            except sqlite3.OperationalError as e:
-                self.loading_popup.dismiss()
-                if "database is locked" in str(e):
+            # Si el SKU ya existe no falla: se añaden sus EANs nuevos (upsert)
+            (_, resultado), = self.upsert_products([(sku, title, eans)])
+            self.loading_popup.dismiss()
+            if resultado.startswith('error'):
+                if "database is locked" in resultado:
                     msg = "La base de datos está en uso por otro proceso. Por favor, cierre cualquier programa que esté usando 'db.db' y vuelva a intentarlo."
-                    print(msg)
-                    self.show_warning_popup(msg)
                 else:
-                    raise
+                    msg = f'Error al añadir el producto: {resultado}'
+                print(msg)
+                self.show_warning_popup(msg)
+                return
+            if resultado == 'actualizado':
+                self.status_bar.text = f'Estado: El SKU {sku} ya existía; se añadieron los EANs nuevos'
+            elif resultado == 'sin cambios':
+                self.status_bar.text = f'Estado: El SKU {sku} ya existía con esos EANs'
+            if hasattr(self, 'add_to_db_popup'):  # Verificar si el popup existe
+                self.add_to_db_popup.dismiss()
+            self.ean_sku_id.text = sku
+            self.marca_titulo.text = title
         else:
             self.show_warning_popup('Todos los campos son obligatorios.')
 
@@ -646,6 +2346,15 @@ class ContadorApp(App):
         eans = self.lote_text_input.text.strip().split('\n')
         self.lote_composition = ','.join([f'"{ean.strip()}"' for ean in eans if ean.strip()])
         self.lote_popup.dismiss()
+        # Validar de una sola vez que los componentes del lote existen en la base de datos
+        resolucion = self.resolve_many(eans)
+        if resolucion['missing'] or resolucion['ambiguous']:
+            avisos = []
+            if resolucion['missing']:
+                avisos.append(f"No encontrados en DB ({len(resolucion['missing'])}):\n" + '\n'.join(resolucion['missing'][:10]))
+            if resolucion['ambiguous']:
+                avisos.append(f"EANs con varios productos ({len(resolucion['ambiguous'])}):\n" + '\n'.join(list(resolucion['ambiguous'])[:10]))
+            self.show_warning_popup('Composición de lote:\n' + '\n'.join(avisos))
 
     def on_unit_checkbox_active(self, checkbox, value):
         if value:
@@ -676,7 +2385,7 @@ class ContadorApp(App):
             if self.lock_mode:
                 self.apply_locked_values()
             self.registrar_revision('Solo Revisión')
-            self.status_bar.text = 'Estado: Producto revisado'
+            self.status_bar.text = f'Estado: Producto revisado | {self.escritor_rev.estado()}'
             self.reset_fields()  # Limpiar campos después de revisar
             self.ean_sku_id.focus = True  # Asegurar el foco en el campo "EAN/SKU/ID"
 
@@ -760,54 +2469,25 @@ class ContadorApp(App):
             if self.lock_mode:
                 self.apply_locked_values()
             self.registrar_revision('Revisado y Traducido')
-            self.status_bar.text = 'Estado: Producto traducido'
+            self.status_bar.text = f'Estado: Producto traducido | {self.escritor_rev.estado()}'
             self.reset_fields()  # Limpiar campos después de traducir
             self.ean_sku_id.focus = True  # Asegurar el foco en el campo "EAN/SKU/ID"
 
     def registrar_revision(self, estado):
         ean_sku_id = self.ean_sku_id.text
         marca_titulo = self.marca_titulo.text
-        tipo = self.selected_tipo if hasattr(self, 'selected_tipo') else 'ZZ' if self.check_zz.active else 'LOTE' if self.check_lote.active else 'Set & Pack' if self.check_set_pack.active else 'Consumo' if self.check_consumo.active else 'EDT & EDP' if self.check_edt_edp.active else 'MakeUP' if self.check_makeup.active else ''
-        tiene_pt = 'Tiene PT' if self.check_pt.active else 'No Tiene PT - TRADUZIDO'
-        tiene_es = 'Tiene ES' if self.check_es.active else 'No Tiene ES - TRADUCIDO'
-        tiene_it = 'Tiene IT' if self.check_it.active else 'No Tiene IT - TRADOTTO'
-        cantidad_neta = self.slider_value.text
-        unidad = 'UND' if self.check_und.active else 'ML' if self.check_ml.active else 'GR' if self.check_gr.active else ''
-        composicion_lote = self.lote_composition if self.check_lote.active or self.check_set_pack.active else ''
-        
-        fecha = datetime.now().strftime('%d-%m-%Y')
-        archivo = f'REVs/REV-{fecha}.xlsx'
-        
-        descripcion_col = f'Descripcion{self.traduccion_tipo}' if self.traduccion_tipo else ''
-        modo_empleo_col = f'Modo de Empleo{self.traduccion_tipo}' if self.traduccion_tipo else ''
-        precauciones_col = f'Precauciones{self.traduccion_tipo}' if self.traduccion_tipo else ''
-        mas_informaciones_col = f'Más Informaciones{self.traduccion_tipo}' if self.traduccion_tipo else ''
-        
-        if not os.path.exists('REVs'):
-            os.makedirs('REVs')
+        formulario = self.valores_formulario()
+        tipo = formulario['tipo']
+        tiene_pt = formulario['tiene_pt']
+        tiene_es = formulario['tiene_es']
+        tiene_it = formulario['tiene_it']
+        cantidad_neta = formulario['cantidad_neta']
+        unidad = formulario['unidad']
+        composicion_lote = formulario['composicion_lote']
         
         try:
-            if os.path.exists(archivo):
-                wb = load_workbook(archivo)
-                ws = wb.active
-            else:
-                wb = Workbook()
-                ws = wb.active
-                ws.append(['EAN/SKU/ID', 'MARCA/TITULO', 'Tipo', 'Tiene PT', 'Tiene ES', 'Tiene IT', 'Cantidad Neta', 'UND/ML/GR', 'Composición de Lote', 'Estado', 'DescripcionPT', 'Modo de EmpleoPT', 'PrecaucionesPT', 'Más InformacionesPT', 'DescripcionIT', 'Modo de EmpleoIT', 'PrecaucionesIT', 'Más InformacionesIT'])
-            
-            ws.append([ean_sku_id, marca_titulo, tipo, tiene_pt, tiene_es, tiene_it, cantidad_neta, unidad, composicion_lote, estado, self.descripcion_pt, self.modo_empleo_pt, self.precauciones_pt, self.mas_informaciones_pt, self.descripcion_it, self.modo_empleo_it, self.precauciones_it, self.mas_informaciones_it])
-            try:
-                wb.save(archivo)
-            except PermissionError as e:
-                msg = f"No se puede guardar el archivo de revisiones '{archivo}'. Es posible que esté abierto en otro programa. Por favor, ciérrelo y vuelva a intentarlo."
-                print(msg)
-                self.show_warning_popup(msg)
-                return
-            except Exception as e:
-                msg = f"Error inesperado al guardar el archivo de revisiones: {e}"
-                print(msg)
-                self.show_warning_popup(msg)
-                return
+            # Solo se escribe en el diario; la tabla revisiones y el REV xlsx se actualizan después
+            self.insert_revisions([[ean_sku_id, marca_titulo, tipo, tiene_pt, tiene_es, tiene_it, cantidad_neta, unidad, composicion_lote, estado, self.descripcion_pt, self.modo_empleo_pt, self.precauciones_pt, self.mas_informaciones_pt, self.descripcion_it, self.modo_empleo_it, self.precauciones_it, self.mas_informaciones_it]])
 
             self.reset_fields()  # Limpiar campos después de registrar la revisión
         except Exception as e:
@@ -815,6 +2495,110 @@ class ContadorApp(App):
             print(msg)
             self.show_warning_popup(msg)
 
+    def valores_formulario(self):
+        """Lee una sola vez los valores del formulario que se guardan con cada revisión."""
+        return {
+            'tipo': self.selected_tipo if hasattr(self, 'selected_tipo') else 'ZZ' if self.check_zz.active else 'LOTE' if self.check_lote.active else 'Set & Pack' if self.check_set_pack.active else 'Consumo' if self.check_consumo.active else 'EDT & EDP' if self.check_edt_edp.active else 'MakeUP' if self.check_makeup.active else '',
+            'tiene_pt': 'Tiene PT' if self.check_pt.active else 'No Tiene PT - TRADUZIDO',
+            'tiene_es': 'Tiene ES' if self.check_es.active else 'No Tiene ES - TRADUCIDO',
+            'tiene_it': 'Tiene IT' if self.check_it.active else 'No Tiene IT - TRADOTTO',
+            'cantidad_neta': self.slider_value.text,
+            'unidad': 'UND' if self.check_und.active else 'ML' if self.check_ml.active else 'GR' if self.check_gr.active else '',
+            'composicion_lote': self.lote_composition if self.check_lote.active or self.check_set_pack.active else '',
+        }
+
+    def insert_revisions(self, filas):
+        """
+        Registra revisiones: solo se añaden al diario (append + fsync) y a los conteos del día.
+        retry_revision_journal las guarda después en la tabla revisiones, desde donde EscritorREV las vuelca
+        al REV xlsx. Cada fila es una lista con los valores de REV_HEADERS; las columnas que falten quedan vacías.
+        La importación masiva no pasa por aquí (ImportacionMasiva).
+        """
+        ahora = datetime.now()
+        fecha = ahora.strftime('%Y-%m-%d')
+        hora = ahora.strftime('%H:%M:%S')
+        registros = [{'uid': uuid.uuid4().hex, 'fecha': fecha, 'hora': hora,
+                      'valores': (list(fila) + [''] * len(REV_DB_COLUMNS))[:len(REV_DB_COLUMNS)]} for fila in filas]
+        self.diario_rev.agregar(registros)
+        indice_codigo = REV_DB_COLUMNS.index('ean_sku_id')
+        indice_estado = REV_DB_COLUMNS.index('estado')
+        self.contador_rev.sumar(fecha, ((registro['valores'][indice_codigo], registro['valores'][indice_estado]) for registro in registros))
+
+    def save_revision_records(self, registros):
+        """
+        Inserta (una sola vez por uid) registros de revisión del diario en la tabla revisiones y los encola
+        para el REV xlsx. Ya están contados en contador_rev (insert_revisions o la siembra).
+        """
+        for fecha in {registro['fecha'] for registro in registros}:
+            self.adopt_legacy_rev_workbook(fecha)
+        self.cursor.executemany(
+            SQL_INSERTAR_REVISION,
+            ([registro['uid'], registro['fecha'], registro['hora']] + registro['valores'] for registro in registros))
+        insertadas = self.cursor.rowcount
+        self.conn.commit()
+        if insertadas != len(registros):
+            # Algún uid ya estaba guardado (cierre entre el guardado y el diario): recontar en la próxima lectura
+            self.contador_rev.invalidar()
+        if hasattr(self, 'escritor_rev'):
+            self.escritor_rev.encolar(len(registros))
+
+    def replay_revision_journal(self):
+        """Guarda en la tabla revisiones las líneas del diario que aún no lo están."""
+        if not self.diario_rev.pendientes():
+            return 0
+        registros, posicion = self.diario_rev.leer()
+        if registros:
+            try:
+                self.save_revision_records(registros)
+            except sqlite3.OperationalError:
+                self.conn.rollback()
+                raise
+        self.diario_rev.marcar_guardado(posicion)
+        return len(registros)
+
+    def retry_revision_journal(self, dt=None):
+        """Guarda periódicamente el diario en la tabla revisiones (y lo reintenta si la base de datos está bloqueada)."""
+        try:
+            self.replay_revision_journal()
+        except sqlite3.OperationalError as e:
+            if "database is locked" in str(e):
+                self.status_bar.text = "Estado: La base de datos está en uso por otro proceso. Las revisiones están en el diario y se añadirán a 'db.db' automáticamente."
+            print(f"No se pudo reproducir el diario de revisiones: {e}")
+
+    def adopt_legacy_rev_workbook(self, fecha):
+        """
+        Si existe un REV xlsx de la fecha creado sin la tabla revisiones (versiones anteriores o main.py)
+        y la tabla no tiene revisiones de ese día, incorpora sus filas una sola vez para no perderlas al exportar.
+        Los días anteriores los incorpora IndexadorREV en segundo plano.
+        """
+        if fecha in self.rev_dates_checked:
+            return
+        archivo = ruta_rev(fecha)
+        try:
+            if os.path.exists(archivo) and not self.cursor.execute('SELECT 1 FROM revisiones WHERE fecha = ? LIMIT 1', (fecha,)).fetchone():
+                indexar_archivo_rev(self.conn, archivo, fecha)
+                self.contador_rev.invalidar()
+            self.rev_dates_checked.add(fecha)
+        except Exception as e:
+            print(f"Error al incorporar el archivo de revisiones '{archivo}': {e}")
+
+    def on_rev_index_changed(self, fechas):
+        """IndexadorREV o EscritorREV incorporaron REV xlsx nuevos o modificados: recontar si afectan al día actual."""
+        if datetime.now().strftime('%Y-%m-%d') in fechas:
+            self.contador_rev.invalidar()
+
+    def last_revision_before_today(self, sku):
+        """Devuelve (fecha, estado) de la última revisión del código antes de hoy, o None (consulta indexada)."""
+        return self.cursor.execute(
+            'SELECT fecha, estado FROM revisiones WHERE ean_sku_id = ? AND fecha < ? ORDER BY fecha DESC, id DESC LIMIT 1',
+            (str(sku).strip(), datetime.now().strftime('%Y-%m-%d'))).fetchone()
+
+    def on_export_rev_now(self, instance):
+        """Vuelca ya al REV xlsx las revisiones pendientes, sin esperar al intervalo de escritura diferida."""
+        self.retry_revision_journal()
+        self.escritor_rev.forzar()
+        self.status_bar.text = f'Estado: Guardado del REV xlsx solicitado | {self.escritor_rev.estado()}'
+
     def reset_fields(self):
         self.ean_sku_id.text = ''
         self.marca_titulo.text = ''
@@ -865,11 +2649,55 @@ class ContadorApp(App):
                 self.status_bar.text = f'Estado: Ventana restablecida a tamaño inicial {Window.width}x{Window.height} | Fuente: {base_font}'
             Clock.schedule_once(restore_font_and_status, 0.05)
 
+    def on_diagnostics_key(self, window, key, *args):
+        if key == 293:  # F12
+            self.show_diagnostics_popup()
+            return True
+        return False
+
+    def show_diagnostics_popup(self):
+        """
+        Panel de diagnóstico con las muestras de MuestreadorRecursos y el estado de las cachés del catálogo;
+        se refresca cada segundo mientras está abierto.
+        """
+        content = BoxLayout(orientation='vertical', padding=10, spacing=10)
+        diagnostico = Label(text=self.diagnostics_text(), halign='left', valign='top')
+        diagnostico.bind(size=lambda instance, value: setattr(instance, 'text_size', value))
+        content.add_widget(diagnostico)
+        close_button = Button(text='Cerrar', size_hint=(1, 0.2))
+        content.add_widget(close_button)
+        popup = Popup(title='Diagnóstico', content=content, size_hint=(0.8, 0.8))
+        refresco = Clock.schedule_interval(lambda dt: setattr(diagnostico, 'text', self.diagnostics_text()), RESOURCE_SAMPLE_INTERVAL)
+        close_button.bind(on_press=popup.dismiss)
+        popup.bind(on_dismiss=lambda instance: refresco.cancel())
+        popup.open()
+
+    def diagnostics_text(self):
+        return f'{self.muestreador.resumen()}\n\nCatálogo: {self.catalog_cache_estado}'
+
     def on_historial(self, instance):
+        self.retry_revision_journal()  # Que el historial incluya las revisiones recién registradas
         self.historial_popup = Popup(title='Historial de Revisiones',
                                      content=BoxLayout(orientation='vertical', padding=10, spacing=10),
                                      size_hint=(0.8, 0.8))
-        self.historial_content = BoxLayout(orientation='vertical')
+
+        # Filtros: estado, tipo e ir a una fecha
+        filter_layout = BoxLayout(size_hint=(1, 0.15), spacing=5)
+        self.historial_estado_btn = Button(text='Estado: Todos')
+        self.historial_estado_btn.bind(on_release=lambda btn: self.open_historial_filter(btn, 'estado'))
+        self.historial_tipo_btn = Button(text='Tipo: Todos')
+        self.historial_tipo_btn.bind(on_release=lambda btn: self.open_historial_filter(btn, 'tipo'))
+        self.historial_fecha_input = TextInput(hint_text='dd-mm-aaaa', multiline=False)
+        self.historial_fecha_input.bind(on_text_validate=self.on_historial_ir_fecha)
+        ir_btn = Button(text='Ir', size_hint=(0.4, 1))
+        ir_btn.bind(on_press=self.on_historial_ir_fecha)
+        filter_layout.add_widget(self.historial_estado_btn)
+        filter_layout.add_widget(self.historial_tipo_btn)
+        filter_layout.add_widget(self.historial_fecha_input)
+        filter_layout.add_widget(ir_btn)
+        self.historial_popup.content.add_widget(filter_layout)
+
+        self.historial_content = ListaVirtual()
         self.historial_popup.content.add_widget(self.historial_content)
         
         button_layout = BoxLayout(size_hint=(1, 0.2))
@@ -877,35 +2705,111 @@ class ContadorApp(App):
         self.historial_volver_btn.bind(on_press=self.on_historial_volver)
         self.historial_siguiente_btn = Button(text='Siguiente')
         self.historial_siguiente_btn.bind(on_press=self.on_historial_siguiente)
+        export_rev_btn = Button(text='Exportar XLSX')
+        export_rev_btn.bind(on_press=self.on_export_rev_now)
         button_layout.add_widget(self.historial_volver_btn)
         button_layout.add_widget(self.historial_siguiente_btn)
+        button_layout.add_widget(export_rev_btn)
         
         self.historial_popup.content.add_widget(button_layout)
-        self.historial_index = 0
+        self.historial_filtros = {'estado': None, 'tipo': None}
+        self.historial_cursores = [None]  # Clave (fecha, id) desde la que empieza cada página visitada
         self.load_historial()
         self.historial_popup.open()
 
     def load_historial(self):
-        self.historial_content.clear_widgets()
-        fecha = datetime.now().strftime('%d-%m-%Y')
-        archivo = f'REVs/REV-{fecha}.xlsx'
-        if os.path.exists(archivo):
-            wb = load_workbook(archivo)
-            ws = wb.active
-            rows = list(ws.iter_rows(min_row=2, values_only=True))
-            rows.reverse()
-            for row in rows[self.historial_index:self.historial_index + 5]:
-                self.historial_content.add_widget(Label(text=f'{row[0]}-{row[1]}-{row[2]} / {row[9]}'))
+        """
+        Carga una página del historial (de la más reciente a la más antigua, todas las fechas) con paginación
+        por clave (fecha, id): cada página es una sola lectura de rango sobre un índice, sin OFFSET.
+        """
+        condiciones = []
+        parametros = []
+        for columna in ('estado', 'tipo'):
+            if self.historial_filtros[columna] is not None:
+                condiciones.append(f'{columna} = ?')
+                parametros.append(self.historial_filtros[columna])
+        desde = self.historial_cursores[-1]
+        if desde is not None:
+            condiciones.append('(fecha, id) < (?, ?)')
+            parametros.extend(desde)
+        donde = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+        rows = self.cursor.execute(f'''
+            SELECT id, fecha, hora, ean_sku_id, marca_titulo, tipo, estado FROM revisiones
+            {donde} ORDER BY fecha DESC, id DESC LIMIT ?
+        ''', parametros + [self.HISTORIAL_PAGE_SIZE + 1]).fetchall()
+        self.historial_popup.title = 'Historial de Revisiones'
+        self.historial_hay_siguiente = len(rows) > self.HISTORIAL_PAGE_SIZE
+        rows = rows[:self.HISTORIAL_PAGE_SIZE]
+        self.historial_ultima_clave = (rows[-1][1], rows[-1][0]) if rows else None
+        self.historial_content.data = [
+            {'text': f"{datetime.strptime(fecha, '%Y-%m-%d').strftime('%d-%m-%Y')} {hora} | {ean_sku_id}-{marca_titulo}-{tipo} / {estado}"}
+            for _, fecha, hora, ean_sku_id, marca_titulo, tipo, estado in rows]
+        self.historial_siguiente_btn.disabled = not self.historial_hay_siguiente
+        self.historial_volver_btn.disabled = len(self.historial_cursores) == 1
 
     def on_historial_siguiente(self, instance):
-        self.historial_index += 5
-        self.load_historial()
+        if self.historial_hay_siguiente:
+            self.historial_cursores.append(self.historial_ultima_clave)
+            self.load_historial()
 
     def on_historial_volver(self, instance):
-        if self.historial_index >= 5:
-            self.historial_index -= 5
+        if len(self.historial_cursores) > 1:
+            self.historial_cursores.pop()
+        self.load_historial()
+
+    def open_historial_filter(self, button, columna):
+        """Despliega los valores existentes de estado o tipo para filtrar el historial."""
+        dropdown = DropDown()
+        valores = [None] + [valor for (valor,) in self.cursor.execute(f'SELECT DISTINCT {columna} FROM revisiones ORDER BY {columna}')]
+        for valor in valores:
+            btn = Button(text='Todos' if valor is None else (valor or '(vacío)'), size_hint_y=None, height=44)
+            btn.bind(on_release=lambda btn, valor=valor: dropdown.select(valor))
+            dropdown.add_widget(btn)
+        dropdown.bind(on_select=lambda instance, valor: self.set_historial_filter(columna, valor))
+        dropdown.open(button)
+
+    def set_historial_filter(self, columna, valor):
+        self.historial_filtros[columna] = valor
+        boton = self.historial_estado_btn if columna == 'estado' else self.historial_tipo_btn
+        boton.text = f"{columna.capitalize()}: {'Todos' if valor is None else (valor or '(vacío)')}"
+        self.historial_cursores = [None]
+        self.load_historial()
+
+    def on_historial_ir_fecha(self, instance):
+        """Salta a las revisiones de la fecha indicada (y anteriores)."""
+        texto = self.historial_fecha_input.text.strip()
+        if not texto:
+            self.historial_cursores = [None]
+        else:
+            try:
+                fecha = datetime.strptime(texto, '%d-%m-%Y').strftime('%Y-%m-%d')
+            except ValueError:
+                self.show_warning_popup('Fecha no válida. Use el formato dd-mm-aaaa.')
+                return
+            # Empezar justo después de la última revisión posible de esa fecha
+            self.historial_cursores = [None, (fecha, sys.maxsize)]
+            if (os.path.exists(ruta_rev(fecha))
+                    and not self.cursor.execute('SELECT 1 FROM revisiones WHERE fecha = ? LIMIT 1', (fecha,)).fetchone()):
+                # REV xlsx que IndexadorREV aún no ha incorporado: mostrar sus últimas filas directamente
+                self.show_legacy_historial_tail(fecha)
+                return
         self.load_historial()
 
+    def show_legacy_historial_tail(self, fecha):
+        """Muestra las últimas revisiones de un REV xlsx sin indexar leyendo solo el final de la hoja."""
+        try:
+            filas = [valores for numero, valores in leer_ultimas_filas_xlsx(ruta_rev(fecha), self.HISTORIAL_PAGE_SIZE + 1) if numero > 1]
+        except Exception as e:
+            self.show_warning_popup(f"Error al leer '{ruta_rev(fecha)}': {e}")
+            return
+        fecha_texto = datetime.strptime(fecha, '%Y-%m-%d').strftime('%d-%m-%Y')
+        self.historial_popup.title = 'Historial de Revisiones (REV xlsx pendiente de indexar)'
+        self.historial_content.data = [
+            {'text': f"{fecha_texto} | {valores[0]}-{valores[1]}-{valores[2]} / {valores[9]}"}
+            for valores in ((list(fila) + [''] * len(REV_HEADERS))[:len(REV_HEADERS)] for fila in reversed(filas[-self.HISTORIAL_PAGE_SIZE:]))]
+        self.historial_siguiente_btn.disabled = True
+        self.historial_volver_btn.disabled = False
+
     def on_reset(self, instance):
         self.reset_start_time = datetime.now()
         self.status_bar.text = 'Estado: Mantenga presionado para resetear...'
@@ -1028,6 +2932,26 @@ class ContadorApp(App):
         self.exit_confirmation_popup.dismiss()
         App.get_running_app().stop()
 
+    def on_stop(self):
+        """Detiene los hilos en segundo plano y vuelca las revisiones pendientes al cerrar la aplicación."""
+        # Kivy llama a on_stop dos veces al salir con App.stop() (desde stop() y desde run())
+        if self.detenida:
+            return
+        self.detenida = True
+        if ENABLE_SEARCH_AS_YOU_TYPE:
+            self.buscador_sugerencias.detener()
+        if getattr(self, 'importacion_masiva', None) and self.importacion_masiva.hilo.is_alive():
+            # Una importación sin terminar se deshace (nunca se confirma a medias)
+            self.importacion_masiva.cancelar()
+            self.importacion_masiva.hilo.join()
+        self.retry_revision_journal()
+        if not self.diario_rev.pendientes():
+            self.diario_rev.vaciar()
+        self.diario_rev.cerrar()
+        self.escritor_rev.detener()
+        self.muestreador.detener()
+        self.indexador_rev.detener()
+
     def on_reg_db_press(self, instance):
         self.reg_db_start_time = datetime.now()
         Clock.schedule_once(self.reg_db_ready, 3)
@@ -1092,58 +3016,94 @@ class ContadorApp(App):
 
     def verify_products_in_db(self, file_path):
         """
-        Verifica si los productos del archivo a importar existen en la base de datos.
-        Si no existen, solicita confirmación para registrarlos.
+        Lee una sola vez el archivo a importar (ArchivoImportacion, compartido por todas las etapas)
+        y verifica si sus productos existen en la base de datos. Si no existen, solicita confirmación para registrarlos.
         """
-        wb = load_workbook(file_path)
-        ws = wb.active
-        rows = list(ws.iter_rows(min_row=2, values_only=True))
-        missing_products = []
-
-        for row in rows:
-            sku, titulo, eans = row[:3]
-            self.cursor.execute('SELECT sku FROM productos WHERE sku = ?', (sku,))
-            if not self.cursor.fetchone():
-                missing_products.append((sku, titulo, eans))
+        try:
+            importacion = ArchivoImportacion(file_path)
+            self.verify_import_file(importacion)
+        except Exception as e:
+            self.show_warning_popup(f'Error al leer el archivo: {str(e)}')
+            return
 
-        if missing_products:
-            self.show_missing_products_popup(missing_products, file_path)
+        if importacion.faltantes:
+            self.show_missing_products_popup(importacion)
         else:
-            self.show_import_confirmation(file_path)
+            self.show_import_confirmation(importacion)
+
+    def verify_import_file(self, importacion):
+        """
+        Compara el archivo de importación con el catálogo en una sola pasada de SQL: carga sus filas en una
+        tabla temporal y calcula con joins los SKUs que faltan, los que faltan pero cuyos EANs ya tiene otro
+        producto, y los SKUs existentes con un título distinto. Guarda el resultado en la importación.
+        """
+        self.cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS importacion_filas (
+                fila INTEGER PRIMARY KEY,
+                sku TEXT,
+                titulo TEXT,
+                eans TEXT
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS temp.idx_importacion_filas_sku ON importacion_filas (sku)')
+        try:
+            self.cursor.executemany(
+                'INSERT INTO importacion_filas (fila, sku, titulo, eans) VALUES (?, ?, ?, ?)',
+                ((numero, None if sku is None else str(sku).strip(), titulo, None if eans is None else str(eans))
+                 for numero, (sku, titulo, eans) in zip(importacion.numeros, map(importacion.producto, importacion.filas))))
+            faltantes = self.cursor.execute('''
+                SELECT fila FROM importacion_filas
+                WHERE sku IS NULL OR NOT EXISTS (SELECT 1 FROM productos WHERE productos.sku = importacion_filas.sku)
+                ORDER BY fila
+            ''').fetchall()
+            importacion.coincidencias_ean = {
+                sku: skus.split(',') for sku, skus in self.cursor.execute(f'''
+                    SELECT importacion_filas.sku, group_concat(DISTINCT product_eans.sku)
+                    FROM importacion_filas, json_each({sql_lista_eans('importacion_filas.eans')}) AS lista
+                    JOIN product_eans ON product_eans.ean = {sql_ean('lista.value')}
+                    WHERE importacion_filas.sku IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM productos WHERE productos.sku = importacion_filas.sku)
+                    GROUP BY importacion_filas.sku
+                ''')}
+            importacion.titulos_distintos = self.cursor.execute('''
+                SELECT importacion_filas.sku, importacion_filas.titulo, productos.titulo
+                FROM importacion_filas JOIN productos ON productos.sku = importacion_filas.sku
+                WHERE lower(trim(coalesce(importacion_filas.titulo, ''))) <> lower(trim(coalesce(productos.titulo, '')))
+                ORDER BY importacion_filas.fila
+            ''').fetchall()
+        finally:
+            self.cursor.execute('DELETE FROM importacion_filas')
+            self.conn.commit()
+        # Valores originales del archivo (sin convertir a texto) para registrarlos tal cual
+        filas_por_numero = dict(zip(importacion.numeros, importacion.filas))
+        importacion.faltantes = [importacion.producto(filas_por_numero[fila]) for (fila,) in faltantes]
+        importacion.encontrados = len(importacion) - len(faltantes)
+        return importacion
 
-    def show_missing_products_popup(self, missing_products, file_path):
+    def show_missing_products_popup(self, importacion):
         """
         Muestra un popup con los productos que no existen en la base de datos.
         Permite al usuario decidir si desea registrarlos o continuar sin registrarlos.
         """
         content = BoxLayout(orientation='vertical', spacing=10, padding=10)
-        scroll_view = ScrollView(size_hint=(1, 0.8))
-        # Usar GridLayout para mostrar cada producto en una línea separada y permitir scroll correcto
-        from kivy.uix.gridlayout import GridLayout
-        products_layout = GridLayout(cols=1, size_hint_y=None, spacing=5, padding=[10, 0, 10, 0])
-        products_layout.bind(minimum_height=products_layout.setter('height'))
-
-        for sku, titulo, eans in missing_products:
-            label = Label(
-                text=f"SKU: {sku}\nTítulo: {titulo}\nEANs: {eans}",
-                size_hint_y=None,
-                height=70,
-                halign='left',
-                valign='top',
-                text_size=(500, None),
-                color=(1, 1, 1, 1)
-            )
-            label.bind(size=lambda instance, value: setattr(instance, 'text_size', (instance.width, None)))
-            products_layout.add_widget(label)
-
-        scroll_view.add_widget(products_layout)
-        content.add_widget(scroll_view)
+        content.add_widget(Label(
+            text=(f'{len(importacion.faltantes)} no encontrados ({len(importacion.coincidencias_ean)} coinciden por EAN con otro SKU) | '
+                  f'{importacion.encontrados} encontrados ({len(importacion.titulos_distintos)} con título distinto)'),
+            size_hint=(1, 0.1)))
+        # Lista virtualizada: cada producto en una fila, solo se crean los widgets visibles
+        products_list = ListaVirtual(altura_fila=90, size_hint=(1, 0.7))
+        products_list.data = [
+            {'text': f"SKU: {sku}\nTítulo: {titulo}\nEANs: {eans}"
+                     + (f"\nEAN ya registrado en SKU: {', '.join(importacion.coincidencias_ean[str(sku).strip()])}"
+                        if sku is not None and str(sku).strip() in importacion.coincidencias_ean else '')}
+            for sku, titulo, eans in importacion.faltantes]
+        content.add_widget(products_list)
 
         button_layout = BoxLayout(size_hint=(1, 0.2), spacing=10)
         register_button = Button(text='Registrar en DB')
-        register_button.bind(on_press=lambda x: self.register_missing_products(missing_products, file_path))
+        register_button.bind(on_press=lambda x: self.register_missing_products(importacion))
         continue_button = Button(text='Continuar sin registrar')
-        continue_button.bind(on_press=lambda x: self.show_import_confirmation(file_path))
+        continue_button.bind(on_press=lambda x: self.show_import_confirmation(importacion))
         button_layout.add_widget(register_button)
         button_layout.add_widget(continue_button)
 
@@ -1156,50 +3116,60 @@ class ContadorApp(App):
         )
         self.missing_products_popup.open()
 
-    def register_missing_products(self, missing_products, file_path):
+    def register_missing_products(self, importacion):
         """
         Registra los productos faltantes en la base de datos y continúa con la importación masiva.
+        Las filas que no se pudieron registrar se informan, pero no detienen la importación.
         """
+        missing_products = importacion.faltantes
         self.missing_products_popup.dismiss()
         self.show_progress_popup('Registrando productos en DB...')
 
-        try:
-            for sku, titulo, eans in missing_products:
-                self.cursor.execute('INSERT INTO productos (sku, titulo, eans) VALUES (?, ?, ?)', (sku, titulo, eans))
-            self.conn.commit()
-            self.progress_popup.dismiss()
-            self.status_bar.text = f'{len(missing_products)} productos registrados en DB correctamente.'
-            self.show_import_confirmation(file_path)
-        except sqlite3.OperationalError as e:
-            self.progress_popup.dismiss()
-            if "database is locked" in str(e):
+        inicio = time.perf_counter()
+        informe = self.upsert_products(missing_products)
+        self.progress_popup.dismiss()
+        conteo = {}
+        for sku, resultado in informe:
+            clave = 'error' if resultado.startswith('error') else resultado
+            conteo[clave] = conteo.get(clave, 0) + 1
+        errores = [(sku, resultado) for sku, resultado in informe if resultado.startswith('error')]
+        self.status_bar.text = (f"{conteo.get('insertado', 0)} productos registrados en DB, {conteo.get('actualizado', 0)} actualizados, "
+                                f"{conteo.get('sin cambios', 0)} sin cambios, {conteo.get('error', 0)} errores ({time.perf_counter() - inicio:.1f} s)")
+        if errores:
+            if any("database is locked" in resultado for _, resultado in errores):
                 msg = "La base de datos está en uso por otro proceso. Por favor, cierre cualquier programa que esté usando 'db.db' y vuelva a intentarlo."
-                print(msg)
-                self.show_warning_popup(msg)
             else:
-                self.show_warning_popup(f'Error al registrar productos en DB: {str(e)}')
+                msg = '\n'.join(f'SKU {sku or "(vacío)"}: {resultado}' for sku, resultado in errores[:10])
+                if len(errores) > 10:
+                    msg += f'\n... y {len(errores) - 10} más'
+            print(msg)
+        # Solo siguen faltando los productos que no se pudieron registrar (el informe está en el orden de entrada)
+        importacion.faltantes = [producto for producto, (sku, resultado) in zip(missing_products, informe) if resultado.startswith('error')]
+        self.show_import_confirmation(importacion)
+        if errores:
+            # Encima de la confirmación: al cerrarlo se puede continuar con la importación
+            self.show_warning_popup(f'No se registraron {len(errores)} productos (la importación puede continuar):\n{msg}')
 
     def on_file_selected(self, instance, selection, *args):
         if selection:
             self.file_chooser_popup.dismiss()
             self.verify_products_in_db(selection[0])
 
-    def show_import_confirmation(self, file_path):
-        self.import_file_path = file_path
+    def show_import_confirmation(self, importacion):
+        self.importacion = importacion
+        file_path = importacion.ruta
         try:
-            # Leer el archivo para obtener un resumen
-            wb = load_workbook(file_path)
-            ws = wb.active
-            rows = list(ws.iter_rows(min_row=2, values_only=True))
-            total_rows = len(rows)
+            # Resumen del archivo ya leído en verify_products_in_db
+            total_rows = len(importacion)
 
             # Resumen de características seleccionadas
-            tipo = self.selected_tipo if hasattr(self, 'selected_tipo') else 'ZZ' if self.check_zz.active else 'LOTE' if self.check_lote.active else 'Set & Pack' if self.check_set_pack.active else 'Consumo' if self.check_consumo.active else 'EDT & EDP' if self.check_edt_edp.active else 'MakeUP' if self.check_makeup.active else ''
-            tiene_pt = 'Tiene PT' if self.check_pt.active else 'No Tiene PT - TRADUZIDO'
-            tiene_es = 'Tiene ES' if self.check_es.active else 'No Tiene ES - TRADUCIDO'
-            tiene_it = 'Tiene IT' if self.check_it.active else 'No Tiene IT - TRADOTTO'
-            cantidad_neta = self.slider_value.text
-            unidad = 'UND' if self.check_und.active else 'ML' if self.check_ml.active else 'GR' if self.check_gr.active else ''
+            formulario = self.valores_formulario()
+            tipo = formulario['tipo']
+            tiene_pt = formulario['tiene_pt']
+            tiene_es = formulario['tiene_es']
+            tiene_it = formulario['tiene_it']
+            cantidad_neta = formulario['cantidad_neta']
+            unidad = formulario['unidad']
 
             # Crear el contenido del popup
             content = BoxLayout(orientation='vertical', padding=10, spacing=10)
@@ -1210,12 +3180,17 @@ class ContadorApp(App):
             # Agregar información del archivo y características seleccionadas
             summary_layout.add_widget(Label(text=f'Archivo seleccionado:\n{file_path}', size_hint_y=None, height=60, halign='left', valign='middle', text_size=(500, None)))
             summary_layout.add_widget(Label(text=f'Total de productos a importar: {total_rows}', size_hint_y=None, height=40, halign='left', valign='middle', text_size=(500, None)))
+            if importacion.titulos_distintos:
+                summary_layout.add_widget(Label(text=f'Aviso: {len(importacion.titulos_distintos)} productos con título distinto al de la DB', size_hint_y=None, height=40, halign='left', valign='middle', text_size=(500, None)))
             summary_layout.add_widget(Label(text='Características seleccionadas:', size_hint_y=None, height=30, bold=True))
             summary_layout.add_widget(Label(text=f'- Tipo: {tipo}', size_hint_y=None, height=30))
             summary_layout.add_widget(Label(text=f'- PT: {tiene_pt}', size_hint_y=None, height=30))
             summary_layout.add_widget(Label(text=f'- ES: {tiene_es}', size_hint_y=None, height=30))
             summary_layout.add_widget(Label(text=f'- IT: {tiene_it}', size_hint_y=None, height=30))
             summary_layout.add_widget(Label(text=f'- Cantidad Neta: {cantidad_neta} {unidad}', size_hint_y=None, height=30))
+            if importacion.sobrescrituras:
+                columnas = ', '.join(REV_HEADERS[REV_DB_COLUMNS.index(campo)] for campo in importacion.sobrescrituras)
+                summary_layout.add_widget(Label(text=f'Columnas del archivo que sustituyen al formulario cuando tienen valor: {columnas}', size_hint_y=None, height=40, halign='left', valign='middle', text_size=(500, None)))
 
             scroll_view.add_widget(summary_layout)
             content.add_widget(scroll_view)
@@ -1241,73 +3216,65 @@ class ContadorApp(App):
     def start_mass_import(self, estado):
         self.import_confirmation_popup.dismiss()
         self.show_progress_overlay()
-        Clock.schedule_once(lambda dt: self.perform_mass_import(estado), 0.1)
+        # El formulario se lee aquí, en el hilo principal; el hilo de importación no toca widgets
+        self.adopt_legacy_rev_workbook(datetime.now().strftime('%Y-%m-%d'))
+        self.importacion_masiva = ImportacionMasiva(self.importacion, estado, self.valores_formulario(),
+                                                    on_progreso=self.on_mass_import_progress,
+                                                    on_fin=self.on_mass_import_finished)
 
     def show_progress_overlay(self):
+        content = BoxLayout(orientation='vertical', spacing=5)
+        self.progress_overlay_label = Label(text='Preparando importación...', size_hint=(1, 0.3))
+        self.progress_overlay_bar = ProgressBar(max=100, value=0, size_hint=(1, 0.3))
+        cancel_button = Button(text='Cancelar', size_hint=(1, 0.4))
+        cancel_button.bind(on_press=self.on_mass_import_cancel)
+        content.add_widget(self.progress_overlay_label)
+        content.add_widget(self.progress_overlay_bar)
+        content.add_widget(cancel_button)
         self.progress_overlay = Popup(title='Importando...',
-                                       content=ProgressBar(max=100),
-                                       size_hint=(0.6, 0.2),
+                                       content=content,
+                                       size_hint=(0.6, 0.35),
                                        auto_dismiss=False)
-        self.progress_overlay.content.value = 0
         self.progress_overlay.open()
 
-    def perform_mass_import(self, estado):
-        from openpyxl import load_workbook
+    def on_mass_import_progress(self, procesadas, total, filas_por_segundo):
+        if total:
+            self.progress_overlay_bar.value = min(100, int(procesadas / total * 100))
+        self.progress_overlay_label.text = f'{procesadas}{f" / {total}" if total else ""} filas ({filas_por_segundo:.0f} filas/s)'
 
-        try:
-            wb = load_workbook(self.import_file_path)
-            ws = wb.active
-            rows = list(ws.iter_rows(min_row=2, values_only=True))
-            total_rows = len(rows)
-            fecha = datetime.now().strftime('%d-%m-%Y')
-            archivo = f'REVs/REV-{fecha}.xlsx'
-
-            if not os.path.exists('REVs'):
-                os.makedirs('REVs')
-
-            if os.path.exists(archivo):
-                rev_wb = load_workbook(archivo)
-                rev_ws = rev_wb.active
-            else:
-                rev_wb = Workbook()
-                rev_ws = rev_wb.active
-                rev_ws.append(['EAN/SKU/ID', 'MARCA/TITULO', 'Tipo', 'Tiene PT', 'Tiene ES', 'Tiene IT', 'Cantidad Neta', 'UND/ML/GR', 'Composición de Lote', 'Estado'])
-
-            imported_count = 0
-
-            for i, row in enumerate(rows):
-                try:
-                    sku, titulo, eans = row
-                    tipo = self.selected_tipo if hasattr(self, 'selected_tipo') else 'ZZ' if self.check_zz.active else 'LOTE' if self.check_lote.active else 'Set & Pack' if self.check_set_pack.active else 'Consumo' if self.check_consumo.active else 'EDT & EDP' if self.check_edt_edp.active else 'MakeUP' if self.check_makeup.active else ''
-                    tiene_pt = 'Tiene PT' if self.check_pt.active else 'No Tiene PT - TRADUZIDO'
-                    tiene_es = 'Tiene ES' if self.check_es.active else 'No Tiene ES - TRADUCIDO'
-                    tiene_it = 'Tiene IT' if self.check_it.active else 'No Tiene IT - TRADOTTO'
-                    cantidad_neta = self.slider_value.text
-                    unidad = 'UND' if self.check_und.active else 'ML' if self.check_ml.active else 'GR' if self.check_gr.active else ''
-                    composicion_lote = self.lote_composition if self.check_lote.active or self.check_set_pack.active else ''
-
-                    rev_ws.append([sku, titulo, tipo, tiene_pt, tiene_es, tiene_it, cantidad_neta, unidad, composicion_lote, estado])
-                    imported_count += 1
-                    if hasattr(self, 'progress_overlay'):  # Verificar si el popup existe
-                        self.progress_overlay.content.value = int((i + 1) / total_rows * 100)
-                    self.root.do_layout()
-                except Exception as e:
-                    self.show_warning_popup(f'Error al importar el producto en la fila {i + 2}: {str(e)}')
-
-            rev_wb.save(archivo)
-            if hasattr(self, 'progress_overlay'):  # Verificar si el popup existe
-                self.progress_overlay.dismiss()
-            self.status_bar.text = f'Importación Masiva Completada: {imported_count} productos'
-        except Exception as e:
-            if hasattr(self, 'progress_overlay'):  # Verificar si el popup existe
-                self.progress_overlay.dismiss()
-            self.show_warning_popup(f'Error durante la importación: {str(e)}')
+    def on_mass_import_cancel(self, instance):
+        instance.disabled = True
+        self.progress_overlay_label.text = 'Cancelando...'
+        self.importacion_masiva.cancelar()
+
+    def on_mass_import_finished(self, resultado):
+        self.progress_overlay.dismiss()
+        if resultado['error']:
+            self.show_warning_popup(f"Error durante la importación: {resultado['error']}")
+            return
+        if resultado['cancelado']:
+            self.status_bar.text = f"Estado: Importación cancelada, no se registró ninguna revisión ({resultado['procesadas']} filas descartadas)"
+            return
+        # Las revisiones ya están en la tabla: recontar el día y encolarlas para el REV xlsx
+        self.contador_rev.invalidar()
+        self.escritor_rev.encolar(resultado['insertadas'])
+        self.status_bar.text = (f"Importación Masiva Completada: {resultado['insertadas']} productos en {resultado['segundos']:.1f} s "
+                                f"({resultado['filas_por_segundo']:.0f} filas/s) | {self.escritor_rev.estado()}")
+        if resultado['errores']:
+            detalle = '\n'.join(f'Fila {fila}: {mensaje}' for fila, mensaje in resultado['errores'][:10])
+            mas = f"\n... y {len(resultado['errores']) - 10} más" if len(resultado['errores']) > 10 else ''
+            self.show_warning_popup(f"{len(resultado['errores'])} filas no se importaron:\n{detalle}{mas}")
 
     def on_marca_titulo_enter(self, instance):
         """
         Maneja el evento de presionar Enter en el campo de texto "Marca/Titulo".
         Realiza una búsqueda en la base de datos utilizando las palabras clave ingresadas.
         """
+        if ENABLE_SEARCH_AS_YOU_TYPE:
+            if self.suggestion_event is not None:
+                self.suggestion_event.cancel()
+            self.buscador_sugerencias.cancelar()
+            self.hide_suggestions()
         keywords = self.marca_titulo.text.strip().split()
         if not keywords:
             self.show_warning_popup('El campo Marca/Titulo\nno puede estar vacío.')
@@ -1317,9 +3284,7 @@ class ContadorApp(App):
         self.show_progress_popup('Buscando productos...')
 
         try:
-            # Construir la consulta SQL para buscar coincidencias en la columna "titulo"
-            self.cursor.execute('SELECT sku, titulo FROM productos WHERE ' + ' AND '.join(["titulo LIKE ?" for _ in keywords]), [f'%{kw}%' for kw in keywords])
-            results = self.cursor.fetchall()
+            results = self.search_titles_paginated(keywords)
         except sqlite3.OperationalError as e:
             self.progress_popup.dismiss()
             if "database is locked" in str(e):
@@ -1338,6 +3303,140 @@ class ContadorApp(App):
         else:
             self.show_warning_popup('No se encontraron productos que coincidan con las palabras clave.')
 
+    def title_search_queries(self, keywords):
+        """
+        Devuelve, en orden de preferencia, las consultas posibles para buscar las palabras clave en el título.
+        Todas encuentran al menos lo mismo que la búsqueda LIKE (fragmentos en cualquier parte del título):
+        - índice FTS5 de palabras (prefijos, sin acentos) seguido del índice de trigramas (fragmentos);
+        - índice FTS5 de palabras seguido de la búsqueda LIKE, si no hay índice de trigramas;
+        - búsqueda LIKE.
+        Primero aparecen las coincidencias por palabra, por relevancia bm25, y después las de fragmentos, por rowid.
+        Cada consulta es una tupla (indexada, niveles), con los niveles de ResultadosPaginados.
+        """
+        fragmentos = [kw for kw in keywords if len(kw) >= 3]
+        cortas = [kw for kw in keywords if len(kw) < 3]
+        like = ' AND '.join('productos.titulo LIKE ?' for _ in keywords)
+        parametros_like = [f'%{kw}%' for kw in keywords]
+        # Niveles por fragmentos (sql, parámetros), ordenados por rowid
+        por_fragmentos = []
+        # Índice de trigramas: fragmentos de 3 o más caracteres; las palabras más cortas se filtran con LIKE.
+        # La fila es el rowid de productos_trigram para que FTS5 resuelva el orden y la clave fila > ?
+        if self.trigram_enabled and fragmentos:
+            por_fragmentos.append(('SELECT productos_trigram.rowid AS fila'
+                                   ' FROM productos_trigram JOIN productos ON productos.rowid = productos_trigram.rowid'
+                                   ' WHERE productos_trigram MATCH ?' + ''.join(' AND productos.titulo LIKE ?' for _ in cortas),
+                                   [' AND '.join('"' + kw.replace('"', '""') + '"' for kw in fragmentos)] + [f'%{kw}%' for kw in cortas]))
+        por_fragmentos.append((f'SELECT rowid AS fila FROM productos WHERE {like}', parametros_like))
+        consultas = []
+        # Las palabras clave sin letras ni números (p. ej. "-") no generan tokens FTS5
+        if self.fts_enabled and all(any(c.isalnum() for c in kw) for kw in keywords):
+            # Cada palabra clave como prefijo entre comillas; FTS5 las combina con AND
+            consulta = ' '.join('"' + kw.replace('"', '""') + '"*' for kw in keywords)
+            nivel_palabras = ('SELECT rowid AS fila FROM productos_fts WHERE productos_fts MATCH ? ORDER BY bm25(productos_fts), rowid',
+                              [consulta], False)
+            # Las coincidencias por fragmento que ya son coincidencias por palabra las descarta ResultadosPaginados
+            for sql_fragmentos, parametros_fragmentos in por_fragmentos:
+                consultas.append((True, [nivel_palabras, (sql_fragmentos, parametros_fragmentos, True)]))
+        elif len(por_fragmentos) > 1:
+            sql_fragmentos, parametros_fragmentos = por_fragmentos[0]
+            consultas.append((True, [(sql_fragmentos, parametros_fragmentos, True)]))
+        consultas.append((False, [(f'SELECT rowid AS fila FROM productos WHERE {like}', parametros_like, True)]))
+        return consultas
+
+    def search_titles(self, keywords, cursor, ejecutar):
+        """
+        Recorre las consultas de title_search_queries y devuelve el resultado de la primera que se pueda ejecutar;
+        si una consulta indexada falla (p. ej. sintaxis MATCH no admitida) se prueba la siguiente.
+        ejecutar(cursor, niveles) devuelve el resultado de una consulta.
+        """
+        consultas = self.title_search_queries(keywords)
+        for indexada, niveles in consultas:
+            try:
+                resultado = ejecutar(cursor, niveles)
+            except sqlite3.OperationalError as e:
+                if not indexada or "database is locked" in str(e) or "interrupted" in str(e):
+                    raise
+                print(f"Error en la búsqueda indexada, se probará la siguiente: {e}")
+                continue
+            return resultado
+        return []
+
+    def search_titles_in_db(self, keywords, cursor=None, limit=None):
+        """
+        Busca productos cuyo título contenga todas las palabras clave, como palabras (índice FTS5, sin distinguir
+        acentos) o como fragmentos en cualquier parte (índice de trigramas o, si no está disponible, LIKE).
+        Primero aparecen las coincidencias por palabra, ordenadas por relevancia bm25, y después las de fragmentos.
+        Se puede indicar otro cursor (p. ej. el del hilo de sugerencias) y un límite de resultados.
+        Devuelve una lista de tuplas (sku, titulo).
+        """
+        def ejecutar(cursor, niveles):
+            resultados = ResultadosPaginados(cursor.connection, niveles, limit or EXPORT_FETCH_SIZE)
+            return resultados[0:limit] if limit else list(resultados)
+
+        return self.search_titles(keywords, cursor or self.cursor, ejecutar)
+
+    def search_titles_paginated(self, keywords):
+        """
+        Igual que search_titles_in_db, pero devuelve una secuencia perezosa ResultadosPaginados:
+        cada bloque se lee de SQLite cuando se necesita y el total solo cuando se pide.
+        """
+        def ejecutar(cursor, niveles):
+            resultados = ResultadosPaginados(self.conn, niveles, self.RESULTS_BLOCK_SIZE)
+            # Se leen aquí el primer bloque y una fila de cada nivel por rowid para que search_titles pueda probar
+            # la siguiente consulta si alguna falla (p. ej. sintaxis MATCH no admitida)
+            resultados[0:self.RESULTS_BLOCK_SIZE]
+            for sql, parametros, por_fila in niveles:
+                if por_fila:
+                    cursor.execute(f'SELECT fila FROM ({sql}) LIMIT 1', parametros).fetchall()
+            return resultados
+
+        return self.search_titles(keywords, self.cursor, ejecutar)
+
+    def on_marca_titulo_text(self, instance, text):
+        """
+        Búsqueda mientras se escribe: espera SUGGESTIONS_DEBOUNCE segundos sin pulsaciones
+        y envía la búsqueda al hilo de sugerencias. Cualquier búsqueda en curso se cancela.
+        """
+        if not ENABLE_SEARCH_AS_YOU_TYPE or not instance.focus:
+            return
+        if self.suggestion_event is not None:
+            self.suggestion_event.cancel()
+        self.buscador_sugerencias.cancelar()
+        texto = text.strip()
+        if len(texto) < SUGGESTIONS_MIN_CHARS:
+            self.hide_suggestions()
+            return
+        self.suggestion_event = Clock.schedule_once(lambda dt: self.buscador_sugerencias.solicitar(texto), SUGGESTIONS_DEBOUNCE)
+
+    def show_suggestions(self, texto, results):
+        """Muestra (en el hilo principal) las sugerencias recibidas del hilo de búsqueda."""
+        if texto != self.marca_titulo.text.strip() or not self.marca_titulo.focus:
+            return  # Resultados de un texto que ya cambió
+        self.suggestions_dropdown.clear_widgets()
+        if not results:
+            self.hide_suggestions()
+            return
+        for sku, titulo in results:
+            btn = Button(text=f'{sku} - {titulo}', size_hint_y=None, height=44, shorten=True)
+            btn.bind(on_release=lambda btn, s=sku, t=titulo: self.select_result(s, t))
+            self.suggestions_dropdown.add_widget(btn)
+        if not self.suggestions_dropdown.attach_to:
+            self.suggestions_dropdown.open(self.marca_titulo)
+
+    def hide_suggestions(self):
+        if self.suggestions_dropdown.attach_to:
+            self.suggestions_dropdown.dismiss()
+
+    def select_result(self, sku, titulo):
+        """Carga en el formulario el producto elegido en los resultados o sugerencias de búsqueda."""
+        self.hide_suggestions()
+        if getattr(self, 'results_popup', None):
+            self.results_popup.dismiss()
+        self.ean_sku_id.text = sku
+        self.marca_titulo.text = titulo
+        revision_status = self.check_revision_status(sku)
+        self.show_info_popup('Producto seleccionado', f'SKU: {sku}\nTítulo: {titulo}\n{revision_status}')
+
     def show_progress_popup(self, message):
         """
         Muestra un popup con una barra de progreso y un mensaje.
@@ -1367,20 +3466,19 @@ class ContadorApp(App):
 
         def get_current_block():
             start = self.results_popup_index
-            end = min(start + self.RESULTS_BLOCK_SIZE, len(self.results_full_list))
-            return self.results_full_list[start:end]
+            return self.results_full_list[start:start + self.RESULTS_BLOCK_SIZE]
 
         def update_results_layout():
-            results_layout.clear_widgets()
-            for sku, titulo in get_current_block():
-                result_button = Button(text=f"{sku} - {titulo}", size_hint_y=None, height=44)
-                result_button.bind(on_release=lambda btn, s=sku, t=titulo: self.select_result(s, t))
-                results_layout.add_widget(result_button)
-            # Deshabilitar "Cargar más" si no hay más resultados
-            if self.results_popup_index + self.RESULTS_BLOCK_SIZE >= len(self.results_full_list):
-                load_more_button.disabled = True
-            else:
-                load_more_button.disabled = False
+            results_list.data = [{'text': f"{sku} - {titulo}", 'accion': partial(self.select_result, sku, titulo)}
+                                 for sku, titulo in get_current_block()]
+            results_list.scroll_y = 1
+            # Deshabilitar "Cargar más" si no hay más resultados (sin contar el total: se mira si existe el siguiente)
+            siguiente = self.results_popup_index + self.RESULTS_BLOCK_SIZE
+            load_more_button.disabled = not self.results_full_list[siguiente:siguiente + 1]
+
+        def update_title(dt):
+            # El total (COUNT en una búsqueda paginada) se calcula después de mostrar el primer bloque
+            self.results_popup.title = f'Resultados de la búsqueda ({len(results)}) Productos Encontrados MATCHs'
 
         def on_load_more(instance):
             self.results_popup_index += self.RESULTS_BLOCK_SIZE
@@ -1391,11 +3489,8 @@ class ContadorApp(App):
 
         # --- Layout del popup ---
         content = BoxLayout(orientation='vertical', spacing=10, padding=10)
-        scroll_view = ScrollView(size_hint=(1, 0.7))
-        results_layout = BoxLayout(orientation='vertical', size_hint_y=None)
-        results_layout.bind(minimum_height=results_layout.setter('height'))
-        scroll_view.add_widget(results_layout)
-        content.add_widget(scroll_view)
+        results_list = ListaVirtual(viewclass=FilaBotonVirtual, size_hint=(1, 0.7))
+        content.add_widget(results_list)
 
         # Botones inferiores
         buttons_layout = BoxLayout(size_hint=(1, 0.15), spacing=10)
@@ -1410,14 +3505,14 @@ class ContadorApp(App):
         buttons_layout.add_widget(close_button)
         content.add_widget(buttons_layout)
 
-        num_results = len(results)
         self.results_popup = Popup(
-            title=f'Resultados de la búsqueda ({num_results}) Productos Encontrados MATCHs',
+            title='Resultados de la búsqueda (...) Productos Encontrados MATCHs',
             content=content,
             size_hint=(0.8, 0.8)
         )
         update_results_layout()
         self.results_popup.open()
+        Clock.schedule_once(update_title)
 
     def export_results_to_xlsx(self, results):
         """
@@ -1433,18 +3528,21 @@ class ContadorApp(App):
             if not filename.lower().endswith('.xlsx'):
                 filename += '.xlsx'
             full_path = os.path.join(export_path, filename)
+            def filas_exportacion():
+                # Recorrer los resultados por bloques y obtener los EANs de cada bloque en una sola pasada
+                resultados = iter(results)
+                while True:
+                    bloque = list(islice(resultados, EXPORT_FETCH_SIZE))
+                    if not bloque:
+                        break
+                    encontrados = self.resolve_many((sku for sku, titulo in bloque), by_ean=False)['found']
+                    for sku, titulo in bloque:
+                        producto = encontrados.get(str(sku).strip())
+                        eans = producto[2] if producto and producto[2] else ''
+                        yield [sku, titulo, eans]
+
             try:
-                from openpyxl import Workbook
-                wb = Workbook()
-                ws = wb.active
-                ws.append(['SKU', 'TITULO', 'EANs'])
-                # Obtener los EANs de la base de datos para cada SKU
-                for sku, titulo in results:
-                    self.cursor.execute('SELECT eans FROM productos WHERE sku = ?', (sku,))
-                    row = self.cursor.fetchone()
-                    eans = row[0] if row and row[0] else ''
-                    ws.append([sku, titulo, eans])
-                wb.save(full_path)
+                exportar_filas(full_path, ['SKU', 'TITULO', 'EANs'], filas_exportacion())
                 export_popup.dismiss()
                 self.show_info_popup('Exportación exitosa', f'Archivo exportado:\n{full_path}')
             except Exception as e:
@@ -1468,14 +3566,10 @@ class ContadorApp(App):
 
     def on_f4k3_press(self, instance):
         """
-        Al hacer click en F4K3, registra una revisión predefinida en el archivo REVs del día actual.
+        Al hacer click en F4K3, registra una revisión predefinida en las revisiones del día actual.
         Los valores son de ejemplo y pueden ser modificados posteriormente.
         Permite duplicar la entrada tantas veces como se pulse el botón.
         """
-        from openpyxl import load_workbook, Workbook
-        from datetime import datetime
-        import os
-
         # Valores predefinidos de ejemplo (sin Composición de Lote)
         fake_row = [
             "FAKE",                         # EAN/SKU/ID
@@ -1490,22 +3584,8 @@ class ContadorApp(App):
             "Solo Revisión"                 # Estado
         ]
 
-        fecha = datetime.now().strftime('%d-%m-%Y')
-        archivo = f'REVs/REV-{fecha}.xlsx'
-
-        if not os.path.exists('REVs'):
-            os.makedirs('REVs')
-
         try:
-            if os.path.exists(archivo):
-                wb = load_workbook(archivo)
-                ws = wb.active
-            else:
-                wb = Workbook()
-                ws = wb.active
-                ws.append(['EAN/SKU/ID', 'MARCA/TITULO', 'Tipo', 'Tiene PT', 'Tiene ES', 'Tiene IT', 'Cantidad Neta', 'UND/ML/GR', 'Composición de Lote', 'Estado'])
-            ws.append(fake_row)
-            wb.save(archivo)
+            self.insert_revisions([fake_row])
             self.status_bar.text = 'Estado: Registro F4K3 añadido'
         except Exception as e:
             self.show_warning_popup(f'Error al registrar F4K3: {str(e)}')